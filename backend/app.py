@@ -1,8 +1,26 @@
-<<<<<<< HEAD
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort, g, stream_with_context
 from flask_cors import CORS
 import os
-from database_wrapper import DatabaseWrapper
+import re
+import io
+import csv
+import json
+import itertools
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from database_wrapper import DatabaseWrapper, STORE_DEFAULT
+from interruttore import DBNonDisponibile
+from metriche import metriche
+from cucina import Pianificatore, CAPACITA_DEFAULT
+from ricerca import IndiceProdotti
+from bus import BusLocale
+
+try:
+    import msgpack
+except ImportError:  # opzionale: senza, il delta del menu è solo JSON
+    msgpack = None
 
 # ─────────────────────────── Config ───────────────────────────────
 app = Flask(__name__)
@@ -14,8 +32,232 @@ db = DatabaseWrapper(
     user     = os.getenv("DB_USER",     "avnadmin"),
     password = os.getenv("DB_PASSWORD", "AVNS_your_password_here"),
     db       = os.getenv("DB_NAME",     "hamburger_db"),
+    # es. DB_SHARDS='{"milano": {"host": "...", "db": "hb_milano"}}'
+    shard_map = json.loads(os.getenv("DB_SHARDS", "{}")),
+    # es. DB_REPLICAS='[{"host": "replica-1..."}, {"host": "replica-2..."}]'
+    repliche     = json.loads(os.getenv("DB_REPLICAS", "[]")),
+    max_lag      = float(os.getenv("DB_REPLICA_MAX_LAG", "5")),
+    finestra_ryw = float(os.getenv("DB_RYW_FINESTRA", "2")),
+    # timeout per query e circuit breaker: con il DB lento si risponde subito
+    timeout_connessione = float(os.getenv("DB_TIMEOUT_CONNESSIONE", "5")),
+    timeout_query       = float(os.getenv("DB_TIMEOUT_QUERY", "10")),
+    soglia_errori       = int(os.getenv("DB_INTERRUTTORE_SOGLIA", "5")),
+    latenza_max         = float(os.getenv("DB_LATENZA_MAX", "2")),
+    pausa_interruttore  = float(os.getenv("DB_INTERRUTTORE_PAUSA", "15")),
+    # ordini ricevuti a DB spento, reinviati appena torna
+    coda_ordini = os.getenv("CODA_ORDINI_FILE", "dati/coda_ordini.jsonl"),
 )
 
+# Stazioni della cucina e postazioni parallele, es. '{"griglia": 3, "friggitrice": 2, "bar": 1}'
+CUCINA_STAZIONI = json.loads(os.getenv("CUCINA_STAZIONI", "null")) or CAPACITA_DEFAULT
+cucine = {}                 # store_id -> Pianificatore
+cucine_lock = threading.Lock()
+indici = {}                 # store_id -> IndiceProdotti
+indici_lock = threading.Lock()
+pagine_categoria = {}       # (store_id, categoria_id) -> (versione, corpo JSON, {id prodotti})
+pagine_generazione = {}     # store_id -> n. di invalidazioni (scarta le pagine lette prima)
+pagine_lock = threading.Lock()
+
+# Archiviazione ordini chiusi (consegnati/annullati)
+ARCHIVIO_GIORNI = int(os.getenv("ARCHIVIO_GIORNI", "30"))
+ARCHIVIO_BATCH  = int(os.getenv("ARCHIVIO_BATCH",  "500"))
+ARCHIVIO_PAUSA  = float(os.getenv("ARCHIVIO_PAUSA", "0.2"))
+ARCHIVIO_MAX_BATCH = int(os.getenv("ARCHIVIO_MAX_BATCH", "10"))   # per chiamata
+
+
+# ─────────────────────────── Coerenza fra worker ──────────────────
+# Con più processi (gunicorn -w N) ogni worker ha i suoi indici, piani
+# della cucina e pagine in cache. Le modifiche si propagano come eventi
+# sul BusLocale (socket Unix fra i worker dello stesso host), ognuno con
+# le versioni del menu e i seq degli ordini che ha scritto; il controllo
+# periodico sul DB ricostruisce solo se trova un numero che nessun evento
+# ha portato (evento perso), entro COERENZA_SECONDI.
+# Restano per processo il read-your-writes (db._scritture: una sessione che
+# ha scritto su un worker può leggere da una replica passando da un altro) e
+# per host la coda degli ordini a DB spento (file locale, vedi CodaOrdini).
+BUS_CARTELLA = os.getenv("BUS_DIR") or os.path.join(
+    tempfile.gettempdir(), f"hamburger-bus-{os.getenv('DB_NAME', 'hamburger_db')}"
+)
+COERENZA_SECONDI = float(os.getenv("COERENZA_SECONDI", "5"))
+ricostruito_il = {}         # (store_id, "menu" | "eventi") -> istante dell'ultima ricostruzione da DB
+applicati = {}              # (store_id, "menu" | "eventi") -> {versioni / seq arrivati con gli eventi}
+applicati_lock = threading.Lock()
+
+try:
+    bus = BusLocale(BUS_CARTELLA)
+except OSError as e:   # es. Windows: niente socket Unix datagram
+    print("[app] Bus fra worker non disponibile:", e)
+    bus = None
+
+
+def invalida_pagine(store: str, categorie=(), prodotti=(), tutte: bool = False):
+    """Toglie dalla cache le pagine delle categorie date o che contengono i prodotti dati."""
+    categorie, prodotti = set(categorie), set(prodotti)
+    with pagine_lock:
+        pagine_generazione[store] = pagine_generazione.get(store, 0) + 1
+        for chiave in [k for k, (_, _, pids) in pagine_categoria.items()
+                       if k[0] == store and (tutte or k[1] in categorie or pids & prodotti)]:
+            del pagine_categoria[chiave]
+
+
+def gia_ricostruito(evento: dict, parte: str) -> bool:
+    """L'evento è partito prima dell'ultima ricostruzione da DB di `parte`: è già compreso."""
+    return evento.get("inviato_il", float("inf")) < ricostruito_il.get((evento["store"], parte), 0)
+
+
+def applica_evento(evento: dict):
+    """
+    Aggiorna lo stato in memoria di questo worker dopo una modifica.
+    Tocca solo ciò che è già costruito: il resto verrà letto dal DB al primo uso.
+    """
+    store = evento["store"]
+    with applicati_lock:
+        for parte, numeri in evento.get("scritti", {}).items():
+            applicati.setdefault((store, parte), set()).update(numeri)
+    aggiorna_menu = not gia_ricostruito(evento, "menu")
+    aggiorna_cucina = not gia_ricostruito(evento, "eventi")
+    with indici_lock:
+        indice = indici.get(store)
+    with cucine_lock:
+        cucina = cucine.get(store)
+
+    if evento["tipo"] == "prodotto" and aggiorna_menu:
+        prodotto = evento["prodotto"]   # None = eliminato
+        invalida_pagine(store, [prodotto["categoria_id"]] if prodotto else [], [evento["id"]])
+        if indice is not None:
+            if prodotto:
+                indice.aggiorna(prodotto)
+            else:
+                indice.rimuovi(evento["id"])
+    elif evento["tipo"] == "ordine":
+        if aggiorna_menu and evento["esauriti"]:
+            invalida_pagine(store, prodotti=evento["esauriti"])
+            if indice is not None:
+                for pid in evento["esauriti"]:
+                    indice.segna_non_disponibile(pid)
+        if cucina is not None and aggiorna_cucina:
+            # già presente nel worker che l'ha creato: lì non cambia nulla
+            cucina.aggiungi_ordine(evento["id"], [tuple(r) for r in evento["righe"]],
+                                   evento.get("inviato_il"))
+    elif evento["tipo"] == "stati":
+        if cucina is not None and aggiorna_cucina:
+            rientri = {o["id"]: o for o in evento.get("rientri", [])}
+            for oid, stato in evento["ordini"]:
+                cucina.aggiorna_stato(oid, stato, rientri.get(oid))
+
+
+def notifica(evento: dict):
+    """Applica l'evento a questo worker e lo manda agli altri."""
+    evento = {**evento, "scritti": db.prendi_modifiche()}
+    applica_evento(evento)
+    if bus is not None:
+        bus.pubblica(evento)
+
+
+def notifica_stati(cambi: list[tuple[int, str]]):
+    """
+    Evento "stati" dopo un cambio già salvato. Gli ordini che tornano in
+    cucina e che il piano di questo worker non ha più (es. pronto ->
+    in_preparazione) viaggiano con le righe lette dal DB, così ogni worker
+    li può rimettere nel piano.
+    """
+    with cucine_lock:
+        cucina = cucine.get(g.store)
+    rientrano = [oid for oid, stato in cambi
+                 if stato in ("in_attesa", "in_preparazione")
+                 and (cucina is None or not cucina.contiene(oid))]
+    try:
+        rientri = db.get_ordini_cucina(rientrano) if rientrano else []
+        notifica({"tipo": "stati", "store": g.store, "ordini": cambi, "rientri": rientri})
+    except Exception as e:
+        # il cambio è già su DB: senza evento lo recupera verifica_coerenza
+        print("[app] Notifica dei cambi di stato fallita:", e)
+
+
+if bus is not None:
+    for tipo in ("prodotto", "ordine", "stati"):
+        bus.iscrivi(tipo, applica_evento)
+
+
+def ricostruisci(store: str, parte: str):
+    """Rilegge dal DB indice e pagine (menu) o il piano della cucina (eventi)."""
+    ricostruito_il[(store, parte)] = time.time()
+    if parte == "menu":
+        invalida_pagine(store, tutte=True)
+        with indici_lock:
+            indice = indici.get(store)
+        if indice is not None:
+            indice.carica(db.get_prodotti())
+    else:
+        with cucine_lock:
+            cucina = cucine.get(store)
+        if cucina is not None:
+            cucina.carica(db.get_ordini_cucina())
+    metriche.incrementa(f"coerenza.ricostruzioni.{parte}")
+
+
+def verifica_coerenza():
+    """
+    Rete di sicurezza sotto il bus: ogni COERENZA_SECONDI legge dal
+    primario le versioni del menu e i seq degli ordini scritti dopo il giro
+    precedente, per ogni store in memoria. Se uno non è arrivato con un
+    evento (stabile, cioè più vecchio di MARGINE_COMMIT) ricostruisce quella
+    parte; gli ordini di un pranzo pieno, notificati, non costano nulla.
+    Uno stato vecchio dura al massimo un giro.
+    """
+    riferimenti = {}   # store -> {"menu": versione, "eventi": seq} già verificati
+    db.usa_primario(True)
+    while True:
+        time.sleep(COERENZA_SECONDI)
+        with indici_lock, cucine_lock, pagine_lock:
+            stores = set(indici) | set(cucine) | {s for s, _ in pagine_categoria}
+        with applicati_lock:
+            for chiave in [k for k in applicati if k[0] not in stores]:
+                del applicati[chiave]
+        for store in stores:
+            inizio = time.monotonic()
+            db.usa_store(store)
+            try:
+                novita = db.get_novita(riferimenti.get(store))
+                da_rifare = []
+                for parte, n in novita.items():
+                    with applicati_lock:
+                        arrivati = applicati.get((store, parte), set())
+                        persi = [x for x, stabile in n["nuovi"]
+                                 if stabile and x not in arrivati]
+                    if store not in riferimenti or persi or n["troncato"]:
+                        da_rifare.append(parte)
+                for parte in da_rifare:
+                    ricostruisci(store, parte)
+                with applicati_lock:
+                    for parte, n in novita.items():
+                        arrivati = applicati.get((store, parte), set())
+                        if parte in da_rifare:
+                            arrivati |= {x for x, _ in n["nuovi"]}
+                        # sotto il riferimento non si guarda più
+                        applicati[(store, parte)] = {x for x in arrivati if x > n["fino_a"]}
+                riferimenti[store] = {parte: n["fino_a"] for parte, n in novita.items()}
+            except Exception:
+                riferimenti.pop(store, None)   # al prossimo giro si ricostruisce comunque
+                metriche.incrementa("coerenza.verifiche_fallite")
+            metriche.osserva("coerenza.verifica_ms", (time.monotonic() - inizio) * 1000)
+
+
+threading.Thread(target=verifica_coerenza, name="verifica-coerenza", daemon=True).start()
+
+
+def ordine_reinviato(store: str, result: dict):
+    """Un ordine della coda locale è arrivato su DB: entra nel piano della cucina."""
+    notifica({
+        "tipo": "ordine", "store": store, "id": result["id"],
+        "righe": [(r["preparazione"], r["quantita"]) for r in result["righe"]],
+        "esauriti": result["esauriti"],
+    })
+
+
+db.avvia_svuotamento_coda(float(os.getenv("CODA_ORDINI_SECONDI", "5")), ordine_reinviato)
+db.avvia_misura_repliche()
+
 
 # ─────────────────────────── Helpers ──────────────────────────────
 def ok(data=None, msg: str = "OK", code: int = 200):
@@ -29,10 +271,105 @@ def err(msg: str, code: int = 400):
     return jsonify({"success": False, "message": msg}), code
 
 
+def istante(t: float) -> str:
+    return datetime.fromtimestamp(t).isoformat(sep=" ", timespec="seconds")
+
+
+def intervallo_date(default: timedelta) -> tuple[datetime, datetime]:
+    """?da=...&a=... in formato ISO; senza `a` si arriva ad adesso, senza `da` si va indietro di `default`."""
+    try:
+        a  = datetime.fromisoformat(request.args["a"]) if "a" in request.args else datetime.now()
+        da = (datetime.fromisoformat(request.args["da"]) if "da" in request.args
+              else a - default)
+    except ValueError:
+        raise ValueError("'da' e 'a' devono essere date ISO (es. 2025-01-31 12:00)")
+    if da >= a:
+        raise ValueError("'da' deve precedere 'a'")
+    return da, a
+
+
+def cucina_corrente() -> Pianificatore:
+    """Pianificatore dello store della richiesta, costruito al primo uso."""
+    with cucine_lock:
+        cucina = cucine.get(g.store)
+        if cucina is None:
+            cucina = cucine[g.store] = Pianificatore(CUCINA_STAZIONI)
+            cucina.carica(db.get_ordini_cucina())
+    return cucina
+
+
+def indice_corrente() -> IndiceProdotti:
+    """Indice di ricerca dello store della richiesta, costruito al primo uso."""
+    with indici_lock:
+        indice = indici.get(g.store)
+        if indice is None:
+            indice = indici[g.store] = IndiceProdotti()
+            indice.carica(db.get_prodotti())
+    return indice
+
+
+def ordine_json(o: dict) -> dict:
+    """Converte i Decimal di un ordine (e delle sue righe) in float."""
+    o["totale"] = float(o["totale"])
+    for r in o["righe"]:
+        r["prezzo_unit"] = float(r["prezzo_unit"])
+    return o
+
+
+# ─────────────────────────── Store ────────────────────────────────
+STORE_ID_RE = re.compile(r"^[a-z0-9_-]{1,40}$")
+
+
+@app.before_request
+def imposta_contesto():
+    """
+    Il punto vendita arriva dall'header X-Store-Id (o da ?store=).
+    La sessione (X-Session-Id, altrimenti l'IP) serve al read-your-writes:
+    chi ha appena scritto rilegge dal primario e non da una replica.
+    """
+    store = request.headers.get("X-Store-Id") or request.args.get("store") or STORE_DEFAULT
+    if not STORE_ID_RE.match(store):
+        return err(f"Store non valido: {store}")
+    g.store = store
+    db.usa_store(store)
+    db.usa_sessione(request.headers.get("X-Session-Id") or request.remote_addr)
+    db.prendi_modifiche()   # scarta quelle di una richiesta precedente finita male
+
+
+@app.after_request
+def segnala_degrado(response):
+    """Le risposte servite dall'ultima istantanea hanno X-Degradato: 1."""
+    if db.risposta_degradata():
+        response.headers["X-Degradato"] = "1"
+    return response
+
+
+@app.errorhandler(DBNonDisponibile)
+def db_non_disponibile(e):
+    metriche.incrementa("db.degradato.rifiutate")
+    corpo, codice = err("Database momentaneamente non disponibile, riprova tra poco", 503)
+    corpo.headers["Retry-After"] = "5"
+    return corpo, codice
+
+
 # ─────────────────────────── Health ───────────────────────────────
 @app.route("/api/health", methods=["GET"])
 def health():
-    return ok(msg="HamBurger backend operativo 🍔")
+    """Non interroga il DB: risponde anche con l'interruttore aperto."""
+    interruttori = db.stato_interruttori()
+    in_coda = len(db.coda) if db.coda is not None else 0
+    degradato = any(i["stato"] != "chiuso" for i in interruttori.values())
+    return ok(
+        {"db": interruttori, "ordini_in_coda": in_coda,
+         "stato": "degradato" if degradato else "operativo"},
+        "HamBurger backend in modalità degradata" if degradato
+        else "HamBurger backend operativo 🍔",
+    )
+
+
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    return ok(metriche.snapshot())
 
 
 # ─────────────────────────── SETUP ────────────────────────────────
@@ -55,6 +392,33 @@ def get_menu():
     return ok(menu)
 
 
+@app.route("/api/menu/delta", methods=["GET"])
+def get_menu_delta():
+    """
+    Solo le modifiche al menu dopo ?versione=N (0 o assente = menu completo).
+    Con ?formato=msgpack o Accept: application/x-msgpack risponde in MessagePack.
+    """
+    try:
+        da_versione = int(request.args.get("versione", 0))
+    except ValueError:
+        return err("Il parametro 'versione' deve essere un intero")
+    delta = db.get_menu_delta(da_versione)
+    prodotti = [m["dati"] for m in delta.get("modifiche", [])
+                if m["tipo"] == "prodotto" and "dati" in m]
+    prodotti += [p for cat in delta.get("menu", []) for p in cat["prodotti"]]
+    for p in prodotti:
+        p["prezzo"] = float(p["prezzo"])
+
+    vuole_msgpack = (request.args.get("formato") == "msgpack"
+                     or "application/x-msgpack" in request.headers.get("Accept", ""))
+    if not vuole_msgpack:
+        return ok(delta)
+    if msgpack is None:
+        return err("MessagePack non disponibile su questo server", 406)
+    corpo = msgpack.packb({"success": True, "message": "OK", "data": delta})
+    return app.response_class(corpo, mimetype="application/x-msgpack")
+
+
 # ─────────────────────────── CATEGORIE ────────────────────────────
 @app.route("/api/categorie", methods=["GET"])
 def get_categorie():
@@ -74,6 +438,50 @@ def add_categoria():
         return err(str(e))
 
 
+def risposta_pagina(versione: int, corpo: str, cid: int):
+    """Pagina di categoria con ETag legato alla versione (304 se il client ce l'ha già)."""
+    etag = f"{g.store}-{cid}-{versione}"
+    if request.if_none_match.contains(etag):
+        risposta = app.response_class(status=304)
+    else:
+        risposta = app.response_class(corpo, mimetype="application/json")
+    risposta.set_etag(etag)
+    # il client può tenerla, ma deve sempre ricontrollare l'ETag
+    risposta.headers["Cache-Control"] = "no-cache"
+    return risposta
+
+
+@app.route("/api/categorie/<int:cid>/prodotti", methods=["GET"])
+def get_prodotti_categoria(cid: int):
+    """
+    Prodotti di una sola categoria, per il kiosk che li carica al tocco.
+    La pagina serializzata resta in cache finché un evento non tocca la
+    categoria o uno dei suoi prodotti (vedi invalida_pagine): le richieste
+    servite dalla cache non interrogano il DB.
+    """
+    chiave = (g.store, cid)
+    with pagine_lock:
+        salvata = pagine_categoria.get(chiave)
+        generazione = pagine_generazione.get(g.store, 0)
+    if salvata is not None:
+        metriche.incrementa("cache.categorie.hit")
+        return risposta_pagina(salvata[0], salvata[1], cid)
+
+    metriche.incrementa("cache.categorie.miss")
+    pagina = db.get_prodotti_categoria(cid)
+    if pagina is None:
+        return err("Categoria non trovata", 404)
+    for p in pagina["prodotti"]:
+        p["prezzo"] = float(p["prezzo"])
+    corpo = app.json.dumps({"success": True, "message": "OK", "data": pagina["prodotti"]})
+    with pagine_lock:
+        # se nel frattempo è arrivata un'invalidazione, la pagina letta può essere vecchia
+        if pagine_generazione.get(g.store, 0) == generazione:
+            pagine_categoria[chiave] = (pagina["versione"], corpo,
+                                        {p["id"] for p in pagina["prodotti"]})
+    return risposta_pagina(pagina["versione"], corpo, cid)
+
+
 # ─────────────────────────── PRODOTTI ─────────────────────────────
 @app.route("/api/prodotti", methods=["GET"])
 def get_prodotti():
@@ -83,6 +491,25 @@ def get_prodotti():
     return ok(prodotti)
 
 
+@app.route("/api/prodotti/cerca", methods=["GET"])
+def cerca_prodotti():
+    """Autocompletamento: ?q=chee&limite=10 (senza accenti, per prefisso o simile)."""
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return err("Il parametro 'q' è obbligatorio")
+    try:
+        limite = min(int(request.args.get("limite", 10)), 50)
+    except ValueError:
+        return err("Il parametro 'limite' deve essere un intero")
+    if limite < 1:
+        return err("Il parametro 'limite' deve essere almeno 1")
+    indice = indice_corrente()
+    inizio = time.perf_counter()
+    risultati = indice.cerca(q, limite)
+    metriche.osserva("ricerca.ms", (time.perf_counter() - inizio) * 1000)
+    return ok(risultati)
+
+
 @app.route("/api/prodotti/<int:pid>", methods=["GET"])
 def get_prodotto(pid: int):
     p = db.get_prodotto(pid)
@@ -106,9 +533,12 @@ def add_prodotto():
             descrizione  = (body.get("descrizione") or "").strip(),
             prezzo       = float(body["prezzo"]),
             immagine     = body.get("immagine"),
+            scorte       = int(body["scorte"]) if body.get("scorte") is not None else None,
+            preparazione = body.get("preparazione"),
         )
         prodotto = db.get_prodotto(pid)
         prodotto["prezzo"] = float(prodotto["prezzo"])
+        notifica({"tipo": "prodotto", "store": g.store, "id": pid, "prodotto": prodotto})
         return ok(prodotto, "Prodotto creato", 201)
     except Exception as e:
         return err(str(e))
@@ -124,6 +554,10 @@ def update_prodotto(pid: int):
     if "prezzo"        in body: fields["prezzo"]         = float(body["prezzo"])
     if "immagine"      in body: fields["immagine"]       = body["immagine"]
     if "disponibile"   in body: fields["disponibile"]    = int(bool(body["disponibile"]))
+    if "preparazione"  in body: fields["preparazione"]   = body["preparazione"]
+    if "scorte"        in body:
+        # null = scorte non tracciate per questo prodotto
+        fields["scorte"] = int(body["scorte"]) if body["scorte"] is not None else None
     if not fields:
         return err("Nessun campo da aggiornare")
     updated = db.update_prodotto(pid, **fields)
@@ -131,6 +565,7 @@ def update_prodotto(pid: int):
         return err("Prodotto non trovato", 404)
     prodotto = db.get_prodotto(pid)
     prodotto["prezzo"] = float(prodotto["prezzo"])
+    notifica({"tipo": "prodotto", "store": g.store, "id": pid, "prodotto": prodotto})
     return ok(prodotto, "Prodotto aggiornato")
 
 
@@ -139,6 +574,7 @@ def delete_prodotto(pid: int):
     deleted = db.delete_prodotto(pid)
     if not deleted:
         return err("Prodotto non trovato", 404)
+    notifica({"tipo": "prodotto", "store": g.store, "id": pid, "prodotto": None})
     return ok(msg="Prodotto eliminato")
 
 
@@ -147,11 +583,11 @@ def delete_prodotto(pid: int):
 def get_ordini():
     stato = request.args.get("stato")
     ordini = db.get_ordini(stato)
+    stime = cucina_corrente().stime()
     for o in ordini:
-        o["totale"] = float(o["totale"])
-        for r in o["righe"]:
-            r["prezzo_unit"] = float(r["prezzo_unit"])
-    return ok(ordini)
+        if o["id"] in stime:
+            o["pronto_stimato"] = istante(stime[o["id"]])
+    return ok([ordine_json(o) for o in ordini])
 
 
 @app.route("/api/ordini/<int:oid>", methods=["GET"])
@@ -159,10 +595,7 @@ def get_ordine(oid: int):
     o = db.get_ordine(oid)
     if not o:
         return err("Ordine non trovato", 404)
-    o["totale"] = float(o["totale"])
-    for r in o["righe"]:
-        r["prezzo_unit"] = float(r["prezzo_unit"])
-    return ok(o)
+    return ok(ordine_json(o))
 
 
 @app.route("/api/ordini", methods=["POST"])
@@ -172,9 +605,26 @@ def crea_ordine():
     if not righe:
         return err("Il carrello è vuoto")
     try:
-        result = db.crea_ordine(righe, body.get("note", ""))
+        try:
+            result = db.crea_ordine(righe, body.get("note", ""))
+        except DBNonDisponibile:
+            # DB giù: l'ordine va nella coda locale e si reinvia più tardi
+            result = db.accoda_ordine(righe, body.get("note", ""))
+            return ok(result, "Ordine ricevuto, verrà inviato in cucina a breve", 202)
         result["totale"] = float(result["totale"])
+        righe_cucina = [(r["preparazione"], r["quantita"]) for r in result.pop("righe")]
+        # l'ordine è già salvato: un errore da qui in poi non deve farlo
+        # reinviare al kiosk (sarebbe un doppione), si risponde senza stima
+        try:
+            pronto = cucina_corrente().aggiungi_ordine(result["id"], righe_cucina)
+            result["pronto_stimato"] = istante(pronto)
+            notifica({"tipo": "ordine", "store": g.store, "id": result["id"],
+                      "righe": righe_cucina, "esauriti": result["esauriti"]})
+        except Exception as e:
+            print("[app] Ordine", result["id"], "salvato, cucina/notifica fallite:", e)
         return ok(result, "Ordine inviato in cucina! 🍔", 201)
+    except DBNonDisponibile:
+        raise   # coda non configurata: 503
     except ValueError as e:
         return err(str(e))
     except Exception as e:
@@ -191,110 +641,192 @@ def update_stato_ordine(oid: int):
         updated = db.update_stato_ordine(oid, stato)
         if not updated:
             return err("Ordine non trovato", 404)
+        notifica_stati([(oid, stato)])
         return ok(msg=f"Stato aggiornato a '{stato}'")
     except ValueError as e:
         return err(str(e))
 
 
-# ─────────────────────────── STATS ────────────────────────────────
-@app.route("/api/stats", methods=["GET"])
-def get_stats():
-    stats = db.get_stats()
-    stats["incasso"] = float(stats["incasso"] or 0)
-    return ok(stats)
-
-
-# ─────────────────────────── Main ─────────────────────────────────
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
-=======
-from flask import Flask, jsonify, request
-from flask_cors import CORS
-from database_wrapper import DatabaseWrapper
-
-app = Flask(__name__)
-# Configurazione CORS più esplicita per supportare tutte le origini
-CORS(app, resources={
-    r"/.*": {
-        "origins": "*",
-        "methods": ["GET", "POST", "PATCH", "OPTIONS", "DELETE", "PUT"],
-        "allow_headers": ["Content-Type", "Authorization"],
-        "supports_credentials": False
-    }
-})
-db = DatabaseWrapper()
-db.crea_tabelle_se_non_esistono()  # Crea le tabelle in automatico all'avvio!
-
-
-@app.route('/menu', methods=['GET'])
-def get_menu():
+@app.route("/api/ordini/stato", methods=["PATCH"])
+def update_stati_ordini():
+    """
+    Cambi di stato in blocco (es. "bump" della cucina).
+    body = {"transizioni": [{"id": X, "stato": ..., "expected_stato": ...}, ...]}
+    Ritorna gli ordini cambiati (o già nello stato chiesto) più gli eventuali conflitti.
+    """
+    body = request.get_json(silent=True) or {}
+    transizioni = body.get("transizioni") if isinstance(body, dict) else body
+    if not transizioni or not isinstance(transizioni, list):
+        return err("Il campo 'transizioni' è obbligatorio")
     try:
-        return jsonify(db.get_menu())
-    except Exception as e:
-        return jsonify({'error': 'server error', 'detail': str(e)}), 500
-
-
-@app.route('/')
-def index():
-    return "<h3>Hamburgeria backend</h3><p>API disponibili: <a href='/menu'>/menu</a>, <a href='/orders'>/orders</a></p>"
+        result = db.update_stati_ordini(transizioni)
+    except ValueError as e:
+        return err(str(e))
+    result["aggiornati"] = [ordine_json(o) for o in result["aggiornati"]]
+    if result["aggiornati"]:
+        notifica_stati([(o["id"], o["stato"]) for o in result["aggiornati"]])
+    if not result["aggiornati"] and result["conflitti"]:
+        return jsonify({"success": False, "message": "Nessuno stato aggiornato",
+                        "data": result}), 409
+    return ok(result, f"{len(result['aggiornati'])} ordini aggiornati")
+
+
+# ─────────────────────────── EVENTI ───────────────────────────────
+@app.route("/api/eventi", methods=["GET"])
+def get_eventi():
+    """Coda del log eventi: ?da_seq=N&limite=500. Ripartire da `ultimo_seq`."""
+    try:
+        da_seq = int(request.args.get("da_seq", 0))
+        limite = min(int(request.args.get("limite", 500)), 5000)
+    except ValueError:
+        return err("'da_seq' e 'limite' devono essere interi")
+    if limite < 1:
+        return err("Il parametro 'limite' deve essere almeno 1")
+    eventi = db.get_eventi(da_seq, limite)
+    ultimo = eventi[-1]["seq"] if eventi else da_seq
+    return ok({"eventi": eventi, "ultimo_seq": ultimo})
+
+
+@app.route("/api/eventi/tempi", methods=["GET"])
+def get_tempi_fasi():
+    """
+    Percentili dei tempi per fase (attesa, preparazione, ritiro, totale)
+    per gli ordini creati in ?da=...&a=... (default: ultime 2 ore).
+    """
+    try:
+        da, a = intervallo_date(timedelta(hours=2))
+    except ValueError as e:
+        return err(str(e))
+    return ok({"da": str(da), "a": str(a), "fasi": db.get_tempi_fasi(da, a)})
 
 
-@app.route('/menu', methods=['POST'])
-def add_menu_item():
-    data = request.get_json() or {}
-    name = data.get('name') or data.get('nome')
-    category = data.get('category') or data.get('categoria')
-    price = data.get('price') or data.get('prezzo')
-    image = data.get('image') or data.get('immagine')
-    if not name or price is None:
-        return jsonify({'error': 'name and price required'}), 400
-    new_id = db.add_product(name, category or 'panini', price, image)
-    return jsonify({'id': new_id}), 201
+# ─────────────────────────── EXPORT ───────────────────────────────
+COLONNE_EXPORT = ["ordine_id", "numero", "stato", "creato_il", "aggiornato_il",
+                  "totale", "note", "archiviato",
+                  "prodotto_id", "prodotto", "quantita", "prezzo_unit"]
+BLOCCO_EXPORT = 64 * 1024   # byte accumulati prima di mandare un pezzo di risposta
 
 
-@app.route('/orders', methods=['GET'])
-def get_orders():
+def righe_csv(ordini):
+    """Una riga CSV per riga d'ordine (i campi dell'ordine si ripetono)."""
+    buf = io.StringIO()
+    scrivi = csv.writer(buf)
+    scrivi.writerow(COLONNE_EXPORT)
+    for o in ordini:
+        testa = [o["id"], o["numero"], o["stato"], o["creato_il"], o["aggiornato_il"],
+                 o["totale"], o["note"] or "", int(o["archiviato"])]
+        for r in o["righe"] or [{}]:
+            scrivi.writerow(testa + [r.get("prodotto_id"), r.get("prodotto"),
+                                     r.get("quantita"), r.get("prezzo_unit")])
+        if buf.tell() >= BLOCCO_EXPORT:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def righe_ndjson(ordini):
+    """Un ordine JSON (con le sue righe) per riga."""
+    blocco = []
+    dimensione = 0
+    for o in ordini:
+        o["totale"] = float(o["totale"])
+        o["creato_il"], o["aggiornato_il"] = str(o["creato_il"]), str(o["aggiornato_il"])
+        for r in o["righe"]:
+            r["prezzo_unit"] = float(r["prezzo_unit"])
+            del r["ordine_id"]
+        riga = json.dumps(o, ensure_ascii=False) + "\n"
+        blocco.append(riga)
+        dimensione += len(riga)
+        if dimensione >= BLOCCO_EXPORT:
+            yield "".join(blocco)
+            blocco, dimensione = [], 0
+    yield "".join(blocco)
+
+
+@app.route("/api/export/ordini", methods=["GET"])
+def esporta_ordini():
+    """
+    Storico ordini in streaming: ?da=...&a=... (default: ultimi 30 giorni),
+    ?formato=csv|ndjson (default csv), ?archivio=0 per escludere gli archiviati.
+    La risposta parte subito ed è chunked: la memoria non dipende dal numero di ordini.
+    """
     try:
-        return jsonify(db.get_orders())
-    except Exception as e:
-        return jsonify({'error': 'server error', 'detail': str(e)}), 500
+        da, a = intervallo_date(timedelta(days=30))
+    except ValueError as e:
+        return err(str(e))
+    formato = request.args.get("formato", "csv")
+    if formato not in ("csv", "ndjson"):
+        return err("Il parametro 'formato' deve essere 'csv' o 'ndjson'")
+
+    ordini = db.esporta_ordini(da, a, archivio=request.args.get("archivio") != "0")
+    # il primo next() apre le connessioni: un DB giù risponde 503, non un file troncato
+    primo = next(ordini, None)
+    ordini = itertools.chain([primo] if primo else [], ordini)
+    formatta, mimetype = ((righe_csv, "text/csv") if formato == "csv"
+                          else (righe_ndjson, "application/x-ndjson"))
+    nome = f"ordini_{g.store}_{da:%Y%m%d}_{a:%Y%m%d}.{formato}"
+    return Response(
+        stream_with_context(formatta(ordini)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{nome}"'},
+    )
+
+
+# ─────────────────────────── CUCINA ───────────────────────────────
+@app.route("/api/cucina", methods=["GET"])
+def get_piano_cucina():
+    """Piano della cucina: orario stimato di ogni ordine e coda di ogni stazione."""
+    piano = cucina_corrente().piano()
+    return ok({
+        "ordini": {oid: istante(t) for oid, t in piano["ordini"].items()},
+        "stazioni": {
+            stazione: [{"ordine_id": c["ordine_id"],
+                        "inizio": istante(c["inizio"]),
+                        "fine": istante(c["fine"])} for c in compiti]
+            for stazione, compiti in piano["stazioni"].items()
+        },
+    })
 
 
-@app.route('/orders', methods=['POST'])
-def create_order():
-    data = request.get_json() or {}
-    items = data.get('items') or data.get('lista_prodotti')
-    total = data.get('total_price') or data.get('totale')
-    if items is None or total is None:
-        return jsonify({'error': 'items and total_price required'}), 400
-    try:
-        order_id = db.add_order(items, total)
-        return jsonify({'id': order_id}), 201
-    except Exception as e:
-        return jsonify({'error': 'server error', 'detail': str(e)}), 500
+# ─────────────────────────── STATS ────────────────────────────────
+@app.route("/api/stats", methods=["GET"])
+def get_stats():
+    stats = db.get_stats()
+    stats["incasso"] = float(stats["incasso"] or 0)
+    return ok(stats)
 
 
-@app.route('/orders/<int:order_id>', methods=['PATCH'])
-def patch_order(order_id):
-    data = request.get_json() or {}
-    status = data.get('status') or data.get('stato')
-    if not status:
-        return jsonify({'error': 'status required'}), 400
-    try:
-        db.update_order_status(order_id, status)
-        return jsonify({'ok': True})
-    except Exception as e:
-        return jsonify({'error': 'server error', 'detail': str(e)}), 500
+@app.route("/api/stats/negozi", methods=["GET"])
+def get_stats_negozi():
+    """Statistiche di oggi di tutti i punti vendita (fan-out sugli shard)."""
+    stats = db.get_stats_globali()
+    for s in stats["negozi"].values():
+        s["incasso"] = float(s["incasso"] or 0)
+    return ok(stats)
 
 
-@app.errorhandler(404)
-def not_found(e):
-    return jsonify({
-        'error': 'Not Found',
-        'available_endpoints': ['/menu (GET, POST)', '/orders (GET, POST)', '/orders/<id> (PATCH)']
-    }), 404
+# ─────────────────────────── ARCHIVIO ─────────────────────────────
+@app.route("/api/archivio", methods=["POST"])
+def archivia_ordini():
+    """
+    Sposta in archivio gli ordini chiusi più vecchi di `giorni`, al massimo
+    ARCHIVIO_MAX_BATCH blocchi per chiamata: con "altri": true il client
+    (o il cron) richiama finché non ne restano.
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        result = db.archivia_ordini(
+            giorni      = int(body.get("giorni", ARCHIVIO_GIORNI)),
+            batch       = int(body.get("batch",  ARCHIVIO_BATCH)),
+            pausa       = ARCHIVIO_PAUSA,
+            max_blocchi = ARCHIVIO_MAX_BATCH,
+        )
+        return ok(result, f"{result['archiviati']} ordini archiviati")
+    except ValueError as e:
+        return err(str(e))
 
 
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
->>>>>>> 690fc1a (inizio del progetto, parte ordini e aggiunta al menù)
+# ─────────────────────────── Main ─────────────────────────────────
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,104 @@
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+
+from metriche import metriche
+
+MAX_MESSAGGIO = 60 * 1024   # byte; i datagrammi Unix più grandi vengono rifiutati
+
+
+class BusLocale:
+    """
+    Bus di eventi fra i worker di uno stesso host (gunicorn -w N, più
+    processi dietro lo stesso proxy).
+
+    Ogni worker apre un socket Unix datagram `<cartella>/<pid>.sock`;
+    pubblica() manda il messaggio a tutti gli altri socket della cartella,
+    un thread per worker li riceve e chiama le funzioni iscritte al tipo.
+    Niente broker né dipendenze: se un worker muore il suo socket resta
+    orfano e viene tolto al primo invio fallito.
+
+    La consegna non è garantita (coda del ricevente piena, worker appena
+    avviato): chi usa il bus deve avere anche un controllo periodico sul
+    DB che limiti quanto a lungo uno stato può restare vecchio.
+    """
+
+    def __init__(self, cartella: str):
+        self.cartella = cartella
+        os.makedirs(cartella, exist_ok=True)
+        self.percorso = os.path.join(cartella, f"{os.getpid()}.sock")
+        if os.path.exists(self.percorso):
+            os.unlink(self.percorso)   # pid riusato dopo un crash
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.percorso)
+        self._invio = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._invio.setblocking(False)   # un worker bloccato non blocca chi pubblica
+        self._lock = threading.Lock()
+        self._iscritti = {}   # tipo -> [funzione(evento)]
+        atexit.register(self.chiudi)
+        threading.Thread(target=self._ricevi, name="bus-locale", daemon=True).start()
+
+    def iscrivi(self, tipo: str, funzione):
+        with self._lock:
+            self._iscritti.setdefault(tipo, []).append(funzione)
+
+    def pubblica(self, evento: dict) -> int:
+        """Manda `evento` (deve avere "tipo") agli altri worker; ritorna a quanti."""
+        corpo = json.dumps(
+            {**evento, "origine": os.getpid(), "inviato_il": time.time()},
+            default=str,
+        ).encode()
+        if len(corpo) > MAX_MESSAGGIO:
+            metriche.incrementa("bus.troppo_grandi")
+            return 0
+        inviati = 0
+        for voce in os.scandir(self.cartella):
+            if not voce.name.endswith(".sock") or voce.path == self.percorso:
+                continue
+            try:
+                self._invio.sendto(corpo, voce.path)
+                inviati += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # worker terminato: nessuno ascolta più su quel socket
+                try:
+                    os.unlink(voce.path)
+                except FileNotFoundError:
+                    pass
+            except (BlockingIOError, OSError):
+                metriche.incrementa("bus.persi")
+        metriche.incrementa("bus.inviati", inviati)
+        return inviati
+
+    def chiudi(self):
+        try:
+            os.unlink(self.percorso)
+        except FileNotFoundError:
+            pass
+        self._sock.close()
+        self._invio.close()
+
+    # ─────────────────────────── Interni ──────────────────────────
+
+    def _ricevi(self):
+        while True:
+            try:
+                corpo = self._sock.recv(MAX_MESSAGGIO)
+            except OSError:
+                return   # socket chiuso
+            try:
+                evento = json.loads(corpo)
+            except ValueError:
+                continue
+            metriche.incrementa("bus.ricevuti")
+            metriche.osserva("bus.propagazione_ms",
+                             (time.time() - evento["inviato_il"]) * 1000)
+            with self._lock:
+                funzioni = list(self._iscritti.get(evento.get("tipo"), []))
+            for funzione in funzioni:
+                try:
+                    funzione(evento)
+                except Exception as e:
+                    print("[BusLocale] Evento non applicato:", evento.get("tipo"), e)
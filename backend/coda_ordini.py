@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo processo, basta il lock fra thread
+    fcntl = None
+
+
+class CodaOrdini:
+    """
+    Ordini accettati mentre il DB non risponde, salvati su un file JSONL
+    locale (una riga per ordine) e reinviati quando il DB torna.
+    Gli ordini che al reinvio non sono più validi (prodotto tolto,
+    esaurito) finiscono in `<file>.scartati` con il motivo.
+
+    Il file è condiviso dai worker dello stesso host: ogni lettura-modifica-
+    scrittura avviene sotto flock su `<file>.lock`, e uno solo alla volta
+    reinvia (flock su `<file>.reinvio`), così nessun ordine parte due volte.
+    """
+
+    def __init__(self, percorso: str):
+        self.percorso = percorso
+        self._lock = threading.Lock()
+        cartella = os.path.dirname(percorso)
+        if cartella:
+            os.makedirs(cartella, exist_ok=True)
+
+    def aggiungi(self, voce: dict) -> int:
+        """Accoda un ordine e ritorna quanti ce ne sono in coda."""
+        with self._bloccato():
+            self._scrivi_riga(self.percorso, voce)
+            return len(self._leggi())
+
+    def voci(self) -> list[dict]:
+        with self._bloccato():
+            return self._leggi()
+
+    def __len__(self) -> int:
+        return len(self.voci())
+
+    def togli(self, coda_id: str):
+        """Ordine reinviato: esce dalla coda."""
+        with self._bloccato():
+            self._riscrivi([v for v in self._leggi() if v["coda_id"] != coda_id])
+
+    def scarta(self, voce: dict, motivo: str):
+        with self._bloccato():
+            self._scrivi_riga(self.percorso + ".scartati", {**voce, "motivo": motivo})
+            self._riscrivi([v for v in self._leggi() if v["coda_id"] != voce["coda_id"]])
+
+    @contextmanager
+    def reinvio(self):
+        """
+        with coda.reinvio() as mio: se `mio` è False un altro worker sta
+        già reinviando la coda e questo deve lasciar perdere.
+        """
+        with open(self.percorso + ".reinvio", "a") as f:
+            if fcntl is None:
+                yield True
+                return
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # ─────────────────────────── Interni ──────────────────────────
+
+    @contextmanager
+    def _bloccato(self):
+        with self._lock, open(self.percorso + ".lock", "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _leggi(self) -> list[dict]:
+        try:
+            with open(self.percorso, encoding="utf-8") as f:
+                return [json.loads(riga) for riga in f if riga.strip()]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _scrivi_riga(percorso: str, voce: dict):
+        with open(percorso, "a", encoding="utf-8") as f:
+            f.write(json.dumps(voce, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _riscrivi(self, voci: list[dict]):
+        # file temporaneo + rename: un crash non lascia la coda a metà
+        temporaneo = self.percorso + ".tmp"
+        with open(temporaneo, "w", encoding="utf-8") as f:
+            for v in voci:
+                f.write(json.dumps(v, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaneo, self.percorso)
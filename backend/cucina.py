@@ -0,0 +1,200 @@
+import heapq
+import threading
+import time
+
+# postazioni che lavorano in parallelo per ogni stazione
+CAPACITA_DEFAULT = {"griglia": 2, "friggitrice": 1, "bar": 1}
+
+# secondi di priorità guadagnati da un ordine per ogni secondo di attesa:
+# evita che gli ordini grossi restino in fondo per sempre
+INVECCHIAMENTO = 0.5
+
+
+def leggi_preparazione(testo: str | None) -> list[tuple[str, int]]:
+    """'griglia:240,friggitrice:180' -> [("griglia", 240), ("friggitrice", 180)]"""
+    compiti = []
+    for parte in (testo or "").split(","):
+        stazione, _, secondi = parte.partition(":")
+        try:
+            compiti.append((stazione.strip(), int(secondi)))
+        except ValueError:
+            continue
+    return compiti
+
+
+class Pianificatore:
+    """
+    Stima quando sarà pronto ogni ordine aperto di uno store.
+
+    Ogni riga d'ordine diventa un compito per pezzo su ciascuna stazione
+    indicata in prodotti.preparazione. I compiti vanno sulla prima
+    postazione libera della loro stazione, così un ordine di sole bevande
+    non aspetta dietro la griglia piena.
+    - I nuovi ordini vengono accodati al piano esistente (incrementale,
+      le stime già date non si spostano).
+    - A ogni cambio di stato il piano si rifà: prima gli ordini in
+      preparazione, poi quelli in attesa con il lavoro più breve sulla
+      stazione più carica (SPT), corretto dall'attesa già accumulata.
+    politica="fifo" usa solo l'ordine di arrivo (per confronto nel simulatore).
+    """
+
+    def __init__(self, capacita: dict | None = None, politica: str = "spt",
+                 orologio=time.time):
+        self.capacita = dict(capacita or CAPACITA_DEFAULT)
+        self.politica = politica
+        self._orologio = orologio
+        self._lock = threading.Lock()
+        self._ordini = {}   # id -> {"compiti", "creato_il", "iniziato_il"}
+        self._piano = {}    # id -> [(stazione, inizio, fine)]
+        self._stime = {}    # id -> istante stimato di "pronto"
+        self._libere = {}   # stazione -> heap degli istanti in cui si liberano le postazioni
+
+    # ─────────────────────────── API ──────────────────────────────
+
+    def aggiungi_ordine(self, ordine_id: int, righe: list[tuple[str | None, int]],
+                        creato_il: float | None = None) -> float:
+        """
+        righe = [(preparazione, quantita), ...]
+        Ritorna l'istante (epoch) in cui l'ordine dovrebbe essere pronto.
+        """
+        with self._lock:
+            if ordine_id in self._ordini:
+                # già caricato (es. piano costruito subito dopo l'inserimento)
+                return self._stime[ordine_id]
+            adesso = self._orologio()
+            self._ordini[ordine_id] = {
+                "compiti": self._compiti(righe),
+                "creato_il": creato_il if creato_il is not None else adesso,
+                "iniziato_il": None,
+            }
+            self._pianifica_ordine(ordine_id, adesso)
+            return self._stime[ordine_id]
+
+    def carica(self, ordini: list[dict]):
+        """
+        Ricostruisce il piano da zero (es. all'avvio).
+        ordini = [{"id", "righe": [(preparazione, quantita)], "creato_il", "iniziato_il"}]
+        """
+        with self._lock:
+            self._ordini = {
+                o["id"]: {
+                    "compiti": self._compiti(o["righe"]),
+                    "creato_il": o["creato_il"],
+                    "iniziato_il": o.get("iniziato_il"),
+                }
+                for o in ordini
+            }
+            self._ripianifica(self._orologio())
+
+    def contiene(self, ordine_id: int) -> bool:
+        with self._lock:
+            return ordine_id in self._ordini
+
+    def aggiorna_stato(self, ordine_id: int, stato: str, ordine: dict | None = None):
+        """
+        `ordine` ({"righe", "creato_il", "iniziato_il"}, come in carica) rimette
+        nel piano un ordine già uscito che torna in cucina (pronto -> in_preparazione).
+        """
+        with self._lock:
+            o = self._ordini.get(ordine_id)
+            if o is None:
+                if ordine is None or stato not in ("in_attesa", "in_preparazione"):
+                    return
+                o = self._ordini[ordine_id] = {
+                    "compiti": self._compiti(ordine["righe"]),
+                    "creato_il": ordine["creato_il"],
+                    "iniziato_il": ordine.get("iniziato_il"),
+                }
+            if stato == "in_preparazione":
+                if o["iniziato_il"] is None:
+                    o["iniziato_il"] = self._orologio()
+            elif stato == "in_attesa":
+                o["iniziato_il"] = None
+            else:
+                # pronto, consegnato, annullato: esce dalla cucina
+                del self._ordini[ordine_id]
+            self._ripianifica(self._orologio())
+
+    def stime(self) -> dict[int, float]:
+        with self._lock:
+            return dict(self._stime)
+
+    def piano(self) -> dict:
+        """{"ordini": {id: pronto_stimato}, "stazioni": {stazione: [compiti]}}"""
+        with self._lock:
+            stazioni = {s: [] for s in self.capacita}
+            for oid, compiti in self._piano.items():
+                for stazione, inizio, fine in compiti:
+                    stazioni.setdefault(stazione, []).append(
+                        {"ordine_id": oid, "inizio": inizio, "fine": fine}
+                    )
+            for compiti in stazioni.values():
+                compiti.sort(key=lambda c: c["inizio"])
+            return {"ordini": dict(self._stime), "stazioni": stazioni}
+
+    # ─────────────────────────── Interni ──────────────────────────
+
+    @staticmethod
+    def _compiti(righe) -> list[tuple[str, int]]:
+        compiti = [
+            (stazione, secondi)
+            for preparazione, quantita in righe
+            for stazione, secondi in leggi_preparazione(preparazione)
+            for _ in range(int(quantita))
+        ]
+        # i compiti lunghi per primi: si distribuiscono meglio sulle postazioni
+        compiti.sort(key=lambda c: -c[1])
+        return compiti
+
+    def _lavoro_critico(self, compiti) -> float:
+        """Secondi di lavoro sulla stazione più carica dell'ordine."""
+        per_stazione = {}
+        for stazione, secondi in compiti:
+            per_stazione[stazione] = per_stazione.get(stazione, 0) + secondi
+        return max(
+            (s / self.capacita.get(st, 1) for st, s in per_stazione.items()),
+            default=0,
+        )
+
+    def _priorita(self, oid: int, adesso: float):
+        o = self._ordini[oid]
+        if self.politica == "fifo":
+            return (o["creato_il"], oid)
+        attesa = adesso - o["creato_il"]
+        return (self._lavoro_critico(o["compiti"]) - INVECCHIAMENTO * attesa,
+                o["creato_il"], oid)
+
+    def _postazioni(self, stazione: str, adesso: float) -> list:
+        if stazione not in self._libere:
+            self._libere[stazione] = [adesso] * self.capacita.get(stazione, 1)
+        return self._libere[stazione]
+
+    def _pianifica_ordine(self, oid: int, adesso: float):
+        o = self._ordini[oid]
+        piano = []
+        for stazione, secondi in o["compiti"]:
+            if o["iniziato_il"] is not None:
+                # già sul fuoco: resta solo il tempo mancante
+                secondi = max(0.0, o["iniziato_il"] + secondi - adesso)
+            postazioni = self._postazioni(stazione, adesso)
+            inizio = max(heapq.heappop(postazioni), adesso)
+            fine = inizio + secondi
+            heapq.heappush(postazioni, fine)
+            piano.append((stazione, inizio, fine))
+        self._piano[oid] = piano
+        self._stime[oid] = max((f for _, _, f in piano), default=adesso)
+
+    def _ripianifica(self, adesso: float):
+        self._libere = {}
+        self._piano = {}
+        self._stime = {}
+        in_corso = sorted(
+            (oid for oid, o in self._ordini.items() if o["iniziato_il"] is not None),
+            key=lambda oid: self._ordini[oid]["iniziato_il"],
+        )
+        in_attesa = sorted(
+            (oid for oid, o in self._ordini.items() if o["iniziato_il"] is None),
+            key=lambda oid: self._priorita(oid, adesso),
+        )
+        for oid in in_corso + in_attesa:
+            self._pianifica_ordine(oid, adesso)
@@ -1,16 +1,52 @@
-<<<<<<< HEAD
+import copy
+import time
+import threading
+import uuid
 import pymysql
 import pymysql.cursors
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from metriche import metriche
+from interruttore import Interruttore, DBNonDisponibile
+from coda_ordini import CodaOrdini
+
+STORE_DEFAULT = "principale"
 
 
 class DatabaseWrapper:
     """
     Centralizza tutte le query SQL.
     app.py chiama solo i metodi pubblici di questa classe.
+
+    Ogni dato appartiene a un punto vendita (store_id). Il punto vendita
+    corrente si imposta per thread con usa_store(); la shard_map indica
+    per ciascuno store il DB su cui vive (chi non è in mappa usa il DB base).
+
+    Le letture possono andare sulle repliche del proprio shard: una sessione
+    che ha appena scritto resta però sul primario per `finestra_ryw` secondi,
+    e le repliche in ritardo di più di `max_lag` secondi vengono saltate.
+    Il ritardo lo misura un thread di background (avvia_misura_repliche):
+    le richieste leggono solo l'ultimo valore misurato.
+
+    Ogni shard ha un Interruttore: se il DB non risponde le chiamate
+    falliscono subito con DBNonDisponibile. Intanto menu, categorie e
+    prodotti si servono dall'ultima lettura riuscita e i nuovi ordini
+    finiscono nella coda locale (`coda_ordini`), reinviata al ritorno del DB.
     """
 
-    def __init__(self, host: str, port: int, user: str, password: str, db: str):
+    LAG_TTL = 2.0   # ogni quanto (s) si rimisura il ritardo di una replica
+    LAG_SCADENZA = 3 * LAG_TTL   # misura più vecchia = replica sconosciuta, si salta
+
+    # errori client di pymysql che indicano un DB irraggiungibile o troppo lento
+    ERRORI_CONNESSIONE = {2003, 2006, 2013, 2055}
+    ER_QUERY_TIMEOUT = 3024   # max_execution_time superato
+
+    def __init__(self, host: str, port: int, user: str, password: str, db: str,
+                 shard_map: dict | None = None, repliche: list[dict] | None = None,
+                 max_lag: float = 5.0, finestra_ryw: float = 2.0,
+                 timeout_connessione: float = 5.0, timeout_query: float = 10.0,
+                 soglia_errori: int = 5, latenza_max: float = 2.0,
+                 pausa_interruttore: float = 15.0, coda_ordini: str | None = None):
         self._config = dict(
             host=host,
             port=port,
@@ -20,20 +56,330 @@ class DatabaseWrapper:
             charset="utf8mb4",
             cursorclass=pymysql.cursors.DictCursor,
             autocommit=False,
+            connect_timeout=timeout_connessione,
+            read_timeout=timeout_query,
+            write_timeout=timeout_query,
+            # il server interrompe da sé le SELECT che il client ha smesso di aspettare
+            init_command=f"SET SESSION max_execution_time={int(timeout_query * 1000)}",
         )
+        # chiave shard -> config delle sue repliche
+        self._repliche = {}
+        self._aggiungi_repliche(self._config, repliche or [])
+        # store_id -> config completa dello shard
+        # es. {"milano": {"host": "...", "db": "hb_milano", "repliche": [{"host": "..."}]}}
+        self._shard_map = {}
+        for store, conf in (shard_map or {}).items():
+            conf = dict(conf)
+            repliche_shard = conf.pop("repliche", [])
+            self._shard_map[store] = self._config_shard(self._config, conf)
+            self._aggiungi_repliche(self._shard_map[store], repliche_shard)
+
+        self.max_lag = max_lag
+        self.finestra_ryw = finestra_ryw
+        self._lag = {}                # chiave replica -> (ritardo s | None, misurato_il)
+        self._scritture = {}          # (store, sessione) -> istante ultima scrittura
+        self._turno = 0               # round robin fra le repliche buone
+        self._lock = threading.Lock()
+        self._locale = threading.local()
+
+        self._interruttori = {
+            self._chiave(conf): Interruttore(
+                "{}:{}/{}".format(*self._chiave(conf)), soglia_errori,
+                latenza_max, pausa_interruttore,
+            )
+            for conf in self._shard_distinti()
+        }
+        self._istantanee = {}         # (store, lettura) -> ultimo risultato riuscito
+        self.coda = CodaOrdini(coda_ordini) if coda_ordini else None
+
+    @staticmethod
+    def _config_shard(base: dict, conf: dict) -> dict:
+        config = dict(base)
+        for k, v in conf.items():
+            config["database" if k == "db" else k] = v
+        return config
+
+    @staticmethod
+    def _chiave(config: dict) -> tuple:
+        return (config["host"], config["port"], config["database"])
+
+    def _aggiungi_repliche(self, primario: dict, repliche: list[dict]):
+        if repliche:
+            self._repliche[self._chiave(primario)] = [
+                self._config_shard(primario, r) for r in repliche
+            ]
+
+    # ─────────────────────────── STORE ────────────────────────────
+
+    def usa_store(self, store_id: str):
+        """Imposta il punto vendita per le chiamate di questo thread."""
+        self._locale.store = store_id
+        self._locale.degradato = False
+
+    def _store(self) -> str:
+        return getattr(self._locale, "store", None) or STORE_DEFAULT
+
+    def usa_sessione(self, sessione: str | None):
+        """Identifica il client (kiosk, pannello) per il read-your-writes."""
+        self._locale.sessione = sessione
+
+    def usa_primario(self, attivo: bool):
+        """Manda al primario anche le letture di questo thread (controlli di coerenza)."""
+        self._locale.primario = attivo
+
+    def prendi_modifiche(self) -> dict:
+        """
+        {"menu": [versioni], "eventi": [seq]} scritti da questo thread
+        dall'ultima chiamata: app.py li mette negli eventi del bus.
+        """
+        modifiche = getattr(self._locale, "modifiche", None) or {"menu": [], "eventi": []}
+        self._locale.modifiche = {"menu": [], "eventi": []}
+        return modifiche
+
+    def _segna_modifica(self, parte: str, ident: int):
+        if getattr(self._locale, "modifiche", None) is None:
+            self._locale.modifiche = {"menu": [], "eventi": []}
+        self._locale.modifiche[parte].append(ident)
+
+    def _shard(self, store_id: str) -> dict:
+        return self._shard_map.get(store_id, self._config)
+
+    def _shard_distinti(self) -> list[dict]:
+        """Un config per ogni DB fisico (più store possono condividerlo)."""
+        visti = {}
+        for conf in [self._config, *self._shard_map.values()]:
+            visti.setdefault(self._chiave(conf), conf)
+        return list(visti.values())
+
+    # ─────────────────────────── REPLICHE ─────────────────────────
+
+    def _sessione_recente(self) -> bool:
+        """True se questa sessione ha scritto da meno di finestra_ryw secondi."""
+        sessione = getattr(self._locale, "sessione", None)
+        if not sessione:
+            return False
+        with self._lock:
+            t = self._scritture.get((self._store(), sessione))
+        return t is not None and time.monotonic() - t < self.finestra_ryw
+
+    def _segna_scrittura(self):
+        sessione = getattr(self._locale, "sessione", None)
+        if not sessione:
+            return
+        adesso = time.monotonic()
+        with self._lock:
+            self._scritture[(self._store(), sessione)] = adesso
+            if len(self._scritture) > 10000:
+                self._scritture = {
+                    k: t for k, t in self._scritture.items()
+                    if adesso - t < self.finestra_ryw
+                }
+
+    def _ritardo_replica(self, replica: dict) -> float | None:
+        """
+        Ultimo ritardo misurato della replica, in secondi. None se ferma,
+        irraggiungibile o se il thread di misura non l'ha vista di recente.
+        """
+        with self._lock:
+            lag, misurato_il = self._lag.get(self._chiave(replica), (None, float("-inf")))
+        if time.monotonic() - misurato_il > self.LAG_SCADENZA:
+            return None
+        return lag
+
+    def _misura_ritardo(self, replica: dict):
+        lag = None
+        try:
+            conn = pymysql.connect(**replica)
+            try:
+                with conn.cursor() as cur:
+                    try:
+                        cur.execute("SHOW REPLICA STATUS")
+                        stato = cur.fetchone()
+                        campo = "Seconds_Behind_Source"
+                    except pymysql.err.ProgrammingError:
+                        # MySQL < 8.0.22
+                        cur.execute("SHOW SLAVE STATUS")
+                        stato = cur.fetchone()
+                        campo = "Seconds_Behind_Master"
+                    if stato and stato.get(campo) is not None:
+                        lag = float(stato[campo])
+            finally:
+                conn.close()
+        except pymysql.err.MySQLError:
+            metriche.incrementa("db.repliche.errori")
+
+        with self._lock:
+            self._lag[self._chiave(replica)] = (lag, time.monotonic())
+        metriche.imposta(f"db.repliche.{replica['host']}:{replica['port']}.lag", lag)
+
+    def avvia_misura_repliche(self):
+        """
+        Thread di background che misura il ritardo di tutte le repliche
+        ogni LAG_TTL secondi. Senza, le letture restano sul primario.
+        """
+        repliche = [r for lista in self._repliche.values() for r in lista]
+
+        def ciclo():
+            while True:
+                for replica in repliche:
+                    try:
+                        self._misura_ritardo(replica)
+                    except Exception as e:
+                        print("[DatabaseWrapper] Misura ritardo replica fallita:", e)
+                time.sleep(self.LAG_TTL)
+
+        if repliche:
+            threading.Thread(target=ciclo, name="misura-repliche", daemon=True).start()
+
+    def _config_lettura(self, primario: dict) -> dict:
+        """Sceglie dove mandare una lettura: una replica aggiornata o il primario."""
+        repliche = self._repliche.get(self._chiave(primario))
+        if not repliche or getattr(self._locale, "primario", False):
+            metriche.incrementa("db.letture.primario")
+            return primario
+        if self._sessione_recente():
+            metriche.incrementa("db.letture.primario_ryw")
+            return primario
+
+        buone = []
+        for r in repliche:
+            lag = self._ritardo_replica(r)
+            if lag is not None and lag <= self.max_lag:
+                buone.append(r)
+            else:
+                metriche.incrementa("db.repliche.scartate_lag")
+        if not buone:
+            metriche.incrementa("db.letture.primario_fallback")
+            return primario
+        with self._lock:
+            self._turno += 1
+            scelta = buone[self._turno % len(buone)]
+        metriche.incrementa("db.letture.replica")
+        return scelta
+
+    def _replica_guasta(self, replica: dict, errore: Exception):
+        """Replica che non risponde: esce dalle letture fino alla prossima misura buona."""
+        with self._lock:
+            self._lag[self._chiave(replica)] = (None, time.monotonic())
+        metriche.incrementa("db.repliche.errori")
+        print(f"[DatabaseWrapper] Replica {replica['host']}:{replica['port']} "
+              "non disponibile:", errore)
 
     @contextmanager
-    def _get_conn(self):
-        conn = pymysql.connect(**self._config)
+    def _get_conn(self, config: dict | None = None, lettura: bool = False,
+                  sorgente: dict | None = None, lunga: bool = False):
+        """
+        sorgente: config già scelta con _config_lettura (più connessioni
+                  sulla stessa replica).
+        lunga:    operazioni lunghe per natura (export, archiviazione):
+                  la durata non conta per l'interruttore.
+        L'interruttore è quello del primario dello shard: errori e lentezza
+        di una replica non lo toccano. Una replica che non si connette
+        viene scartata e la lettura passa al primario.
+        """
+        primario = config or self._shard(self._store())
+        if sorgente is not None:
+            config = sorgente
+        elif lettura:
+            config = self._config_lettura(primario)
+        else:
+            config = primario
+
+        if self._chiave(config) != self._chiave(primario):
+            try:
+                conn = pymysql.connect(**config)
+            except pymysql.err.MySQLError as e:
+                self._replica_guasta(config, e)
+                metriche.incrementa("db.letture.primario_fallback")
+                config = primario
+            else:
+                try:
+                    yield conn
+                    conn.commit()
+                except Exception as e:
+                    try:
+                        conn.rollback()
+                    except pymysql.err.MySQLError:
+                        pass   # connessione già persa
+                    if self._errore_connessione(e):
+                        self._replica_guasta(config, e)
+                        raise DBNonDisponibile(str(e)) from e
+                    raise
+                finally:
+                    conn.close()
+                return
+
+        interruttore = self._interruttori[self._chiave(primario)]
+        interruttore.entra()
+        inizio = time.monotonic()
+        try:
+            conn = pymysql.connect(**config)
+        except pymysql.err.MySQLError as e:
+            interruttore.fallimento()
+            raise DBNonDisponibile(str(e)) from e
+        except BaseException:
+            interruttore.rilascia()
+            raise
         try:
             yield conn
             conn.commit()
-        except Exception:
-            conn.rollback()
+            if not lettura:
+                self._segna_scrittura()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except pymysql.err.MySQLError:
+                pass   # connessione già persa
+            if self._errore_connessione(e):
+                interruttore.fallimento()
+                raise DBNonDisponibile(str(e)) from e
+            # errore applicativo o SQL: il DB ha comunque risposto
+            interruttore.successo(0.0 if lunga else time.monotonic() - inizio)
+            raise
+        except BaseException:
+            # es. GeneratorExit da un export chiuso a metà: nessun esito,
+            # ma la prova di un interruttore semi_aperto va liberata
+            interruttore.rilascia()
             raise
+        else:
+            interruttore.successo(0.0 if lunga else time.monotonic() - inizio)
         finally:
             conn.close()
 
+    @classmethod
+    def _errore_connessione(cls, e: Exception) -> bool:
+        if isinstance(e, pymysql.err.InterfaceError):
+            return True
+        codice = e.args[0] if isinstance(e, pymysql.err.MySQLError) and e.args else None
+        return codice in cls.ERRORI_CONNESSIONE or codice == cls.ER_QUERY_TIMEOUT
+
+    # ─────────────────────────── DEGRADO ──────────────────────────
+
+    def stato_interruttori(self) -> dict:
+        """Stato di ogni interruttore, senza toccare il DB (per /api/health)."""
+        return {i.nome: i.stato() for i in self._interruttori.values()}
+
+    def risposta_degradata(self) -> bool:
+        """True se questa richiesta è stata servita da un'istantanea."""
+        return getattr(self._locale, "degradato", False)
+
+    def _con_istantanea(self, nome: str, leggi):
+        """Esegue la lettura e ne tiene una copia; se il DB non c'è, usa la copia."""
+        chiave = (self._store(), nome)
+        try:
+            dati = leggi()
+        except DBNonDisponibile:
+            with self._lock:
+                salvati = self._istantanee.get(chiave)
+            if salvati is None:
+                raise
+            metriche.incrementa("db.degradato.letture_istantanea")
+            self._locale.degradato = True
+            return copy.deepcopy(salvati)
+        with self._lock:
+            self._istantanee[chiave] = copy.deepcopy(dati)
+        return dati
+
     # ─────────────────────────── SETUP ────────────────────────────
 
     def init_schema(self):
@@ -43,32 +389,41 @@ class DatabaseWrapper:
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS categorie (
                         id   INT AUTO_INCREMENT PRIMARY KEY,
-                        nome VARCHAR(80) NOT NULL UNIQUE
+                        store_id VARCHAR(40) NOT NULL DEFAULT 'principale',
+                        nome VARCHAR(80) NOT NULL,
+                        UNIQUE KEY uq_categorie_store_nome (store_id, nome)
                     ) ENGINE=InnoDB;
                 """)
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS prodotti (
                         id          INT AUTO_INCREMENT PRIMARY KEY,
+                        store_id    VARCHAR(40) NOT NULL DEFAULT 'principale',
                         categoria_id INT NOT NULL,
                         nome        VARCHAR(120) NOT NULL,
                         descrizione TEXT,
                         prezzo      DECIMAL(6,2) NOT NULL,
                         immagine    VARCHAR(255),
                         disponibile TINYINT(1) NOT NULL DEFAULT 1,
+                        scorte      INT,
+                        preparazione VARCHAR(120),
+                        INDEX idx_prodotti_store (store_id),
                         FOREIGN KEY (categoria_id) REFERENCES categorie(id) ON DELETE CASCADE
                     ) ENGINE=InnoDB;
                 """)
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS ordini (
                         id          INT AUTO_INCREMENT PRIMARY KEY,
-                        numero      VARCHAR(20) NOT NULL UNIQUE,
+                        store_id    VARCHAR(40) NOT NULL DEFAULT 'principale',
+                        numero      VARCHAR(20) NOT NULL,
                         stato       ENUM('in_attesa','in_preparazione','pronto','consegnato','annullato')
                                     NOT NULL DEFAULT 'in_attesa',
                         note        TEXT,
                         totale      DECIMAL(8,2) NOT NULL DEFAULT 0,
                         creato_il   DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
                         aggiornato_il DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
-                                      ON UPDATE CURRENT_TIMESTAMP
+                                      ON UPDATE CURRENT_TIMESTAMP,
+                        scorte_scalate TINYINT(1) NOT NULL DEFAULT 1,
+                        UNIQUE KEY uq_ordini_store_numero (store_id, numero)
                     ) ENGINE=InnoDB;
                 """)
                 cur.execute("""
@@ -83,10 +438,101 @@ class DatabaseWrapper:
                     ) ENGINE=InnoDB;
                 """)
 
-                # Seed categorie
+                # Archivio: ordini chiusi spostati fuori dalla tabella "calda".
+                # Le righe salvano il nome del prodotto, così non serve la FK
+                # su prodotti e i prodotti vecchi restano eliminabili.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS ordini_archivio (
+                        id          INT PRIMARY KEY,
+                        store_id    VARCHAR(40) NOT NULL,
+                        numero      VARCHAR(20) NOT NULL,
+                        stato       ENUM('in_attesa','in_preparazione','pronto','consegnato','annullato')
+                                    NOT NULL,
+                        note        TEXT,
+                        totale      DECIMAL(8,2) NOT NULL DEFAULT 0,
+                        creato_il   DATETIME NOT NULL,
+                        aggiornato_il DATETIME NOT NULL,
+                        archiviato_il DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE KEY uq_archivio_store_numero (store_id, numero),
+                        INDEX idx_archivio_creato (store_id, creato_il)
+                    ) ENGINE=InnoDB;
+                """)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS righe_ordine_archivio (
+                        id          INT PRIMARY KEY,
+                        ordine_id   INT NOT NULL,
+                        prodotto_id INT NOT NULL,
+                        prodotto    VARCHAR(120) NOT NULL,
+                        quantita    INT NOT NULL DEFAULT 1,
+                        prezzo_unit DECIMAL(6,2) NOT NULL,
+                        INDEX idx_righe_archivio_ordine (ordine_id)
+                    ) ENGINE=InnoDB;
+                """)
+                # prima degli indici con store_id: sulle tabelle vecchie la colonna manca
+                self._migra_store_id(cur)
+                self._crea_indice_se_manca(cur, "ordini", "idx_ordini_creato",
+                                           "store_id, creato_il")
+                self._crea_indice_se_manca(cur, "ordini", "idx_ordini_stato",
+                                           "store_id, stato, creato_il")
+                self._crea_indice_se_manca(cur, "ordini_archivio", "idx_archivio_creato",
+                                           "store_id, creato_il")
+
+                # Log delle modifiche al menu: la versione del menu di uno
+                # store è la massima `versione` registrata per quello store.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS menu_modifiche (
+                        versione     BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        store_id     VARCHAR(40) NOT NULL,
+                        tipo         ENUM('categoria','prodotto') NOT NULL,
+                        entita_id    INT NOT NULL,
+                        categoria_id INT,
+                        operazione   ENUM('upsert','delete') NOT NULL,
+                        creato_il    DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        INDEX idx_menu_modifiche_store (store_id, versione)
+                    ) ENGINE=InnoDB;
+                """)
+                # versione di una sola categoria (GET /api/categorie/<id>/prodotti)
+                self._crea_indice_se_manca(cur, "menu_modifiche",
+                                           "idx_menu_modifiche_categoria",
+                                           "store_id, categoria_id, versione")
+                # Una riga per store: chi modifica il menu la blocca fino al
+                # commit, così le versioni di uno store diventano visibili
+                # nello stesso ordine in cui sono assegnate.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS menu_versioni (
+                        store_id VARCHAR(40) PRIMARY KEY
+                    ) ENGINE=InnoDB;
+                """)
+
+                # Log append-only dei cambi di stato (stato_da NULL = creazione).
+                # Niente FK su ordini: gli eventi restano anche dopo l'archiviazione.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS eventi_ordine (
+                        seq         BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        store_id    VARCHAR(40) NOT NULL,
+                        ordine_id   INT NOT NULL,
+                        stato_da    ENUM('in_attesa','in_preparazione','pronto','consegnato','annullato'),
+                        stato_a     ENUM('in_attesa','in_preparazione','pronto','consegnato','annullato')
+                                    NOT NULL,
+                        creato_il   DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+                        INDEX idx_eventi_store_seq (store_id, seq),
+                        INDEX idx_eventi_store_creato (store_id, creato_il),
+                        INDEX idx_eventi_ordine (ordine_id)
+                    ) ENGINE=InnoDB;
+                """)
+                # Come menu_versioni, per i seq degli eventi di uno store.
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS eventi_versioni (
+                        store_id VARCHAR(40) PRIMARY KEY
+                    ) ENGINE=InnoDB;
+                """)
+
+                # Seed categorie (per il punto vendita corrente)
+                store = self._store()
                 for cat in ("Panini", "Menu", "Bevande", "Extra"):
                     cur.execute(
-                        "INSERT IGNORE INTO categorie (nome) VALUES (%s)", (cat,)
+                        "INSERT IGNORE INTO categorie (store_id, nome) VALUES (%s,%s)",
+                        (store, cat),
                     )
 
                 # Seed prodotti di esempio
@@ -122,42 +568,146 @@ class DatabaseWrapper:
                     ("Extra",  "Onion Rings", "Anelli di cipolla dorati",
                      3.20, "https://images.unsplash.com/photo-1639024471283-03518883512d?w=400"),
                 ]
+                # Tempi di preparazione (stazione:secondi) per categoria
+                preparazione = {
+                    "Panini":  "griglia:240",
+                    "Menu":    "griglia:240,friggitrice:180,bar:20",
+                    "Bevande": "bar:20",
+                    "Extra":   "friggitrice:180",
+                }
                 for (cat, nome, desc, prezzo, img) in seed:
                     cur.execute(
-                        "SELECT id FROM categorie WHERE nome=%s", (cat,)
+                        "SELECT id FROM categorie WHERE store_id=%s AND nome=%s",
+                        (store, cat),
                     )
                     row = cur.fetchone()
                     if row:
                         cur.execute(
                             """INSERT IGNORE INTO prodotti
-                               (categoria_id, nome, descrizione, prezzo, immagine)
-                               SELECT %s,%s,%s,%s,%s
+                               (store_id, categoria_id, nome, descrizione, prezzo,
+                                immagine, preparazione)
+                               SELECT %s,%s,%s,%s,%s,%s,%s
                                WHERE NOT EXISTS
                                (SELECT 1 FROM prodotti WHERE nome=%s AND categoria_id=%s)""",
-                            (row["id"], nome, desc, prezzo, img, nome, row["id"]),
+                            (store, row["id"], nome, desc, prezzo, img,
+                             preparazione[cat], nome, row["id"]),
                         )
 
+    def _crea_indice_se_manca(self, cur, tabella: str, nome: str, colonne: str,
+                              unico: bool = False):
+        """
+        CREATE INDEX non ha IF NOT EXISTS su MySQL: controlla prima.
+        Un indice con lo stesso nome ma colonne diverse (schema più vecchio)
+        viene ricreato.
+        """
+        cur.execute(
+            """SELECT column_name AS colonna FROM information_schema.statistics
+               WHERE table_schema=DATABASE() AND table_name=%s AND index_name=%s
+               ORDER BY seq_in_index""",
+            (tabella, nome),
+        )
+        attuali = [r["colonna"].lower() for r in cur.fetchall()]
+        if attuali == [c.strip().lower() for c in colonne.split(",")]:
+            return
+        if attuali:
+            cur.execute(f"DROP INDEX {nome} ON {tabella}")
+        tipo = "UNIQUE INDEX" if unico else "INDEX"
+        cur.execute(f"CREATE {tipo} {nome} ON {tabella} ({colonne})")
+
+    def _colonna_esiste(self, cur, tabella: str, colonna: str) -> bool:
+        cur.execute(
+            """SELECT 1 FROM information_schema.columns
+               WHERE table_schema=DATABASE() AND table_name=%s AND column_name=%s
+               LIMIT 1""",
+            (tabella, colonna),
+        )
+        return cur.fetchone() is not None
+
+    def _elimina_indice_se_esiste(self, cur, tabella: str, nome: str):
+        cur.execute(
+            """SELECT 1 FROM information_schema.statistics
+               WHERE table_schema=DATABASE() AND table_name=%s AND index_name=%s
+               LIMIT 1""",
+            (tabella, nome),
+        )
+        if cur.fetchone():
+            cur.execute(f"DROP INDEX {nome} ON {tabella}")
+
+    def _migra_store_id(self, cur):
+        """Porta le tabelle create prima del multi-store alla nuova forma."""
+        for tabella in ("categorie", "prodotti", "ordini", "ordini_archivio"):
+            if not self._colonna_esiste(cur, tabella, "store_id"):
+                cur.execute(
+                    f"""ALTER TABLE {tabella} ADD COLUMN store_id VARCHAR(40)
+                        NOT NULL DEFAULT '{STORE_DEFAULT}' AFTER id"""
+                )
+        # nome/numero erano unici globalmente: ora lo sono per store
+        self._elimina_indice_se_esiste(cur, "categorie", "nome")
+        self._crea_indice_se_manca(cur, "categorie", "uq_categorie_store_nome",
+                                   "store_id, nome", unico=True)
+        self._elimina_indice_se_esiste(cur, "ordini", "numero")
+        self._crea_indice_se_manca(cur, "ordini", "uq_ordini_store_numero",
+                                   "store_id, numero", unico=True)
+        self._elimina_indice_se_esiste(cur, "ordini_archivio", "numero")
+        self._crea_indice_se_manca(cur, "ordini_archivio", "uq_archivio_store_numero",
+                                   "store_id, numero", unico=True)
+        self._crea_indice_se_manca(cur, "prodotti", "idx_prodotti_store", "store_id")
+        if not self._colonna_esiste(cur, "prodotti", "scorte"):
+            cur.execute("ALTER TABLE prodotti ADD COLUMN scorte INT AFTER disponibile")
+        if not self._colonna_esiste(cur, "prodotti", "preparazione"):
+            # es. 'griglia:240,friggitrice:180' (stazione:secondi per pezzo)
+            cur.execute("ALTER TABLE prodotti ADD COLUMN preparazione VARCHAR(120)")
+        if not self._colonna_esiste(cur, "ordini", "scorte_scalate"):
+            # gli ordini già presenti non devono essere riscalati al recupero
+            cur.execute(
+                "ALTER TABLE ordini ADD COLUMN scorte_scalate TINYINT(1) NOT NULL DEFAULT 1"
+            )
+        else:
+            # ordini venduti quando le scorte si scalavano a blocchi e mai scalati
+            cur.execute("SELECT id FROM ordini WHERE scorte_scalate=0")
+            sospesi = [r["id"] for r in cur.fetchall()]
+            if sospesi:
+                recuperati = self._scala_ordini(cur, sospesi)
+                metriche.incrementa("scorte.ordini_recuperati", len(recuperati))
+
     # ─────────────────────────── CATEGORIE ────────────────────────
 
     def get_categorie(self) -> list:
-        with self._get_conn() as conn:
+        return self._con_istantanea("categorie", self._get_categorie)
+
+    def _get_categorie(self) -> list:
+        with self._get_conn(lettura=True) as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT id, nome FROM categorie ORDER BY id")
+                cur.execute(
+                    "SELECT id, nome FROM categorie WHERE store_id=%s ORDER BY id",
+                    (self._store(),),
+                )
                 return cur.fetchall()
 
     def add_categoria(self, nome: str) -> int:
         with self._get_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute("INSERT INTO categorie (nome) VALUES (%s)", (nome,))
-                return cur.lastrowid
+                cur.execute(
+                    "INSERT INTO categorie (store_id, nome) VALUES (%s,%s)",
+                    (self._store(), nome),
+                )
+                cat_id = cur.lastrowid
+                self._registra_modifica(cur, "categoria", cat_id, cat_id, "upsert")
+                return cat_id
 
     # ─────────────────────────── PRODOTTI ─────────────────────────
 
     def get_menu(self) -> list:
         """Ritorna tutte le categorie con i relativi prodotti annidati."""
-        with self._get_conn() as conn:
+        return self._con_istantanea("menu", self._get_menu)
+
+    def _get_menu(self) -> list:
+        with self._get_conn(lettura=True) as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT id, nome FROM categorie ORDER BY id")
+                cur.execute(
+                    "SELECT id, nome FROM categorie WHERE store_id=%s ORDER BY id",
+                    (self._store(),),
+                )
                 cats = cur.fetchall()
                 for cat in cats:
                     cur.execute(
@@ -172,68 +722,279 @@ class DatabaseWrapper:
                 return cats
 
     def get_prodotti(self) -> list:
-        with self._get_conn() as conn:
+        return self._con_istantanea("prodotti", self._get_prodotti)
+
+    def _get_prodotti(self) -> list:
+        with self._get_conn(lettura=True) as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT p.id, p.nome, p.descrizione, p.prezzo,
-                           p.immagine, p.disponibile,
+                           p.immagine, p.disponibile, p.scorte,
                            c.id AS categoria_id, c.nome AS categoria
                     FROM prodotti p
                     JOIN categorie c ON c.id = p.categoria_id
+                    WHERE p.store_id=%s
                     ORDER BY c.nome, p.nome
-                """)
+                """, (self._store(),))
                 return cur.fetchall()
 
     def get_prodotto(self, prodotto_id: int) -> dict | None:
-        with self._get_conn() as conn:
+        with self._get_conn(lettura=True) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """SELECT p.*, c.nome AS categoria
                        FROM prodotti p JOIN categorie c ON c.id=p.categoria_id
-                       WHERE p.id=%s""",
-                    (prodotto_id,),
+                       WHERE p.id=%s AND p.store_id=%s""",
+                    (prodotto_id, self._store()),
                 )
                 return cur.fetchone()
 
     def add_prodotto(self, categoria_id: int, nome: str, descrizione: str,
-                     prezzo: float, immagine: str | None) -> int:
+                     prezzo: float, immagine: str | None,
+                     scorte: int | None = None, preparazione: str | None = None) -> int:
         with self._get_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """INSERT INTO prodotti
-                       (categoria_id, nome, descrizione, prezzo, immagine)
-                       VALUES (%s,%s,%s,%s,%s)""",
-                    (categoria_id, nome, descrizione, prezzo, immagine),
+                       (store_id, categoria_id, nome, descrizione, prezzo, immagine,
+                        scorte, preparazione)
+                       SELECT store_id, id, %s, %s, %s, %s, %s, %s
+                       FROM categorie WHERE id=%s AND store_id=%s""",
+                    (nome, descrizione, prezzo, immagine, scorte, preparazione,
+                     categoria_id, self._store()),
                 )
-                return cur.lastrowid
+                if not cur.rowcount:
+                    raise ValueError(f"Categoria {categoria_id} non trovata")
+                pid = cur.lastrowid
+                self._registra_modifica(cur, "prodotto", pid, categoria_id, "upsert")
+        return pid
 
     def update_prodotto(self, prodotto_id: int, **fields) -> bool:
         allowed = {"categoria_id", "nome", "descrizione",
-                   "prezzo", "immagine", "disponibile"}
+                   "prezzo", "immagine", "disponibile", "scorte", "preparazione"}
         updates = {k: v for k, v in fields.items() if k in allowed}
         if not updates:
             return False
+        # rifornimento: il prodotto torna in menu (o esce) con le scorte
+        if updates.get("scorte") is not None and "disponibile" not in updates:
+            updates["disponibile"] = int(updates["scorte"] > 0)
         set_clause = ", ".join(f"{k}=%s" for k in updates)
-        values = list(updates.values()) + [prodotto_id]
+        values = list(updates.values()) + [prodotto_id, self._store()]
         with self._get_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    f"UPDATE prodotti SET {set_clause} WHERE id=%s", values
+                    "SELECT categoria_id FROM prodotti WHERE id=%s AND store_id=%s FOR UPDATE",
+                    (prodotto_id, self._store()),
                 )
-                return cur.rowcount > 0
+                prima = cur.fetchone()
+                if not prima:
+                    return False
+                if "categoria_id" in updates:
+                    cur.execute(
+                        "SELECT 1 FROM categorie WHERE id=%s AND store_id=%s",
+                        (updates["categoria_id"], self._store()),
+                    )
+                    if not cur.fetchone():
+                        raise ValueError(f"Categoria {updates['categoria_id']} non trovata")
+                cur.execute(
+                    f"UPDATE prodotti SET {set_clause} WHERE id=%s AND store_id=%s",
+                    values,
+                )
+                if cur.rowcount == 0:
+                    return True   # esiste, ma i valori erano già questi
+                categoria_id = updates.get("categoria_id", prima["categoria_id"])
+                if categoria_id != prima["categoria_id"]:
+                    # spostato: esce dalla vecchia categoria prima di entrare nella nuova
+                    self._registra_modifica(cur, "prodotto", prodotto_id,
+                                            prima["categoria_id"], "delete")
+                self._registra_modifica(cur, "prodotto", prodotto_id, categoria_id, "upsert")
+                return True
 
     def delete_prodotto(self, prodotto_id: int) -> bool:
         with self._get_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute("DELETE FROM prodotti WHERE id=%s", (prodotto_id,))
-                return cur.rowcount > 0
+                cur.execute(
+                    "SELECT categoria_id FROM prodotti WHERE id=%s AND store_id=%s FOR UPDATE",
+                    (prodotto_id, self._store()),
+                )
+                prima = cur.fetchone()
+                if not prima:
+                    return False
+                cur.execute(
+                    "DELETE FROM prodotti WHERE id=%s AND store_id=%s",
+                    (prodotto_id, self._store()),
+                )
+                self._registra_modifica(cur, "prodotto", prodotto_id,
+                                        prima["categoria_id"], "delete")
+                return True
+
+    # ─────────────────────────── VERSIONI MENU ────────────────────
+
+    MAX_MODIFICHE_DELTA = 200   # oltre, conviene mandare il menu completo
+
+    def _registra_modifica(self, cur, tipo: str, entita_id: int,
+                           categoria_id: int | None, operazione: str):
+        """
+        Da chiamare nella stessa transazione della modifica al menu, dopo
+        aver toccato le righe modificate. AUTO_INCREMENT assegna la versione
+        all'insert, non al commit: senza il lock sulla riga dello store una
+        versione più bassa potrebbe comparire dopo una più alta e un client
+        già passato oltre la perderebbe.
+        """
+        cur.execute(
+            """INSERT INTO menu_versioni (store_id) VALUES (%s)
+               ON DUPLICATE KEY UPDATE store_id=store_id""",
+            (self._store(),),
+        )
+        cur.execute(
+            """INSERT INTO menu_modifiche
+               (store_id, tipo, entita_id, categoria_id, operazione)
+               VALUES (%s,%s,%s,%s,%s)""",
+            (self._store(), tipo, entita_id, categoria_id, operazione),
+        )
+        self._segna_modifica("menu", cur.lastrowid)
+
+    def _versione_menu(self, cur) -> int:
+        cur.execute(
+            "SELECT COALESCE(MAX(versione), 0) AS v FROM menu_modifiche WHERE store_id=%s",
+            (self._store(),),
+        )
+        return cur.fetchone()["v"]
+
+    def _versione_categoria(self, cur, categoria_id: int) -> int:
+        cur.execute(
+            """SELECT COALESCE(MAX(versione), 0) AS v FROM menu_modifiche
+               WHERE store_id=%s AND categoria_id=%s""",
+            (self._store(), categoria_id),
+        )
+        return cur.fetchone()["v"]
+
+    def get_prodotti_categoria(self, categoria_id: int) -> dict | None:
+        """
+        {"versione": V, "prodotti": [...]} letti nella stessa transazione,
+        quindi la versione corrisponde ai prodotti. None se la categoria non c'è.
+        """
+        with self._get_conn(lettura=True) as conn:
+            with conn.cursor() as cur:
+                versione = self._versione_categoria(cur, categoria_id)
+                cur.execute(
+                    "SELECT 1 FROM categorie WHERE id=%s AND store_id=%s",
+                    (categoria_id, self._store()),
+                )
+                if not cur.fetchone():
+                    return None
+                cur.execute(
+                    """SELECT id, nome, descrizione, prezzo,
+                              immagine, disponibile
+                       FROM prodotti
+                       WHERE categoria_id=%s AND store_id=%s
+                       ORDER BY nome""",
+                    (categoria_id, self._store()),
+                )
+                return {"versione": versione, "prodotti": cur.fetchall()}
+
+    def get_menu_delta(self, da_versione: int) -> dict:
+        """
+        Modifiche al menu successive a `da_versione`.
+        Ritorna {"versione": V, "completo": False, "modifiche": [...]}
+        oppure, se il client è troppo indietro, è nuovo o ha una versione
+        che qui non esiste (DB ripristinato, replica più indietro), il menu
+        intero: {"versione": V, "completo": True, "menu": [...]}
+        """
+        with self._get_conn(lettura=True) as conn:
+            with conn.cursor() as cur:
+                versione = self._versione_menu(cur)
+                # un client senza versione riceve sempre il menu intero, anche
+                # da uno store mai modificato (versione 0, nessuna modifica)
+                if da_versione > 0 and da_versione == versione:
+                    return {"versione": versione, "completo": False, "modifiche": []}
+
+                modifiche = []
+                if 0 < da_versione < versione:
+                    cur.execute(
+                        """SELECT versione, tipo, entita_id, operazione
+                           FROM menu_modifiche
+                           WHERE store_id=%s AND versione > %s AND versione <= %s
+                           ORDER BY versione
+                           LIMIT %s""",
+                        (self._store(), da_versione, versione,
+                         self.MAX_MODIFICHE_DELTA + 1),
+                    )
+                    modifiche = cur.fetchall()
+                if (not 0 < da_versione < versione
+                        or len(modifiche) > self.MAX_MODIFICHE_DELTA):
+                    return {"versione": versione, "completo": True,
+                            "menu": self._menu_completo(cur)}
+
+                # per ogni entità conta solo l'ultima modifica
+                ultime = {}
+                for m in modifiche:
+                    ultime.pop((m["tipo"], m["entita_id"]), None)
+                    ultime[(m["tipo"], m["entita_id"])] = m
+
+                dati = {"categoria": {}, "prodotto": {}}
+                cat_ids = [i for (t, i), m in ultime.items()
+                           if t == "categoria" and m["operazione"] == "upsert"]
+                prod_ids = [i for (t, i), m in ultime.items()
+                            if t == "prodotto" and m["operazione"] == "upsert"]
+                if cat_ids:
+                    cur.execute(
+                        "SELECT id, nome FROM categorie WHERE id IN %s AND store_id=%s",
+                        (cat_ids, self._store()),
+                    )
+                    dati["categoria"] = {r["id"]: r for r in cur.fetchall()}
+                if prod_ids:
+                    cur.execute(
+                        """SELECT id, categoria_id, nome, descrizione, prezzo,
+                                  immagine, disponibile
+                           FROM prodotti WHERE id IN %s AND store_id=%s""",
+                        (prod_ids, self._store()),
+                    )
+                    dati["prodotto"] = {r["id"]: r for r in cur.fetchall()}
+
+                risultato = []
+                for (tipo, entita_id), m in ultime.items():
+                    voce = {"versione": m["versione"], "tipo": tipo,
+                            "id": entita_id, "operazione": m["operazione"]}
+                    if m["operazione"] == "upsert":
+                        riga = dati[tipo].get(entita_id)
+                        if riga is None:
+                            # eliminato dopo la lettura della versione
+                            voce["operazione"] = "delete"
+                        else:
+                            voce["dati"] = riga
+                    risultato.append(voce)
+                return {"versione": versione, "completo": False, "modifiche": risultato}
+
+    def _menu_completo(self, cur) -> list:
+        """Come get_menu, ma in due query e sulla connessione data."""
+        cur.execute(
+            "SELECT id, nome FROM categorie WHERE store_id=%s ORDER BY id",
+            (self._store(),),
+        )
+        cats = cur.fetchall()
+        cur.execute(
+            """SELECT id, categoria_id, nome, descrizione, prezzo,
+                      immagine, disponibile
+               FROM prodotti WHERE store_id=%s
+               ORDER BY nome""",
+            (self._store(),),
+        )
+        per_cat = {}
+        for p in cur.fetchall():
+            per_cat.setdefault(p.pop("categoria_id"), []).append(p)
+        for cat in cats:
+            cat["prodotti"] = per_cat.get(cat["id"], [])
+        return cats
 
     # ─────────────────────────── ORDINI ───────────────────────────
 
     def _next_numero_ordine(self, cur) -> str:
         from datetime import datetime
         cur.execute(
-            "SELECT COUNT(*)+1 AS n FROM ordini WHERE DATE(creato_il)=CURDATE()"
+            """SELECT COUNT(*)+1 AS n FROM ordini
+               WHERE store_id=%s AND creato_il >= CURDATE()""",
+            (self._store(),),
         )
         n = cur.fetchone()["n"]
         return f"ORD-{datetime.now():%Y%m%d}-{n:03d}"
@@ -242,58 +1003,290 @@ class DatabaseWrapper:
         """
         righe = [{"prodotto_id": X, "quantita": Y}, ...]
         Ritorna {"id": ..., "numero": ...}
+        Le scorte si scalano nella stessa transazione dell'ordine, con un solo
+        UPDATE condizionato per tutto il carrello: valgono per tutti i worker
+        e un prodotto non si vende oltre l'ultimo pezzo.
         """
+        quantita = self._quantita_carrello(righe)
+        store = self._store()
         with self._get_conn() as conn:
             with conn.cursor() as cur:
                 numero = self._next_numero_ordine(cur)
 
-                # calcola totale
-                totale = 0.0
-                for r in righe:
-                    cur.execute(
-                        "SELECT prezzo FROM prodotti WHERE id=%s AND disponibile=1",
-                        (r["prodotto_id"],),
-                    )
-                    p = cur.fetchone()
-                    if not p:
+                # calcola totale (una query per tutto il carrello)
+                cur.execute(
+                    """SELECT id, prezzo, scorte, preparazione FROM prodotti
+                       WHERE id IN %s AND store_id=%s AND disponibile=1""",
+                    (list(quantita), store),
+                )
+                prodotti = {p["id"]: p for p in cur.fetchall()}
+                for pid in quantita:
+                    if pid not in prodotti:
                         raise ValueError(
-                            f"Prodotto {r['prodotto_id']} non trovato o non disponibile"
+                            f"Prodotto {pid} non trovato o non disponibile"
                         )
-                    r["_prezzo"] = float(p["prezzo"])
-                    totale += r["_prezzo"] * r["quantita"]
+                totale = sum(float(prodotti[pid]["prezzo"]) * q
+                             for pid, q in quantita.items())
+
+                tracciati = {pid: q for pid, q in quantita.items()
+                             if prodotti[pid]["scorte"] is not None}
+                esauriti = self._scala_scorte(cur, tracciati) if tracciati else []
 
                 cur.execute(
-                    "INSERT INTO ordini (numero, note, totale) VALUES (%s,%s,%s)",
-                    (numero, note, totale),
+                    """INSERT INTO ordini (store_id, numero, note, totale)
+                       VALUES (%s,%s,%s,%s)""",
+                    (store, numero, note, totale),
                 )
                 ordine_id = cur.lastrowid
 
-                for r in righe:
-                    cur.execute(
-                        """INSERT INTO righe_ordine
-                           (ordine_id, prodotto_id, quantita, prezzo_unit)
-                           VALUES (%s,%s,%s,%s)""",
-                        (ordine_id, r["prodotto_id"], r["quantita"], r["_prezzo"]),
+                cur.executemany(
+                    """INSERT INTO righe_ordine
+                       (ordine_id, prodotto_id, quantita, prezzo_unit)
+                       VALUES (%s,%s,%s,%s)""",
+                    [(ordine_id, pid, q, float(prodotti[pid]["prezzo"]))
+                     for pid, q in quantita.items()],
+                )
+
+                if esauriti:
+                    # finito l'ultimo pezzo: il prodotto è sparito dal menu
+                    for p in esauriti:
+                        self._registra_modifica(cur, "prodotto", p["id"],
+                                                p["categoria_id"], "upsert")
+                    metriche.incrementa("scorte.esauriti", len(esauriti))
+
+                self._registra_eventi(cur, [(ordine_id, None, "in_attesa")])
+
+        return {
+            "id": ordine_id, "numero": numero, "totale": totale,
+            "righe": [{"prodotto_id": pid, "quantita": q,
+                       "preparazione": prodotti[pid]["preparazione"]}
+                      for pid, q in quantita.items()],
+            "esauriti": [p["id"] for p in esauriti],
+        }
+
+    @staticmethod
+    def _quantita_carrello(righe: list[dict]) -> dict[int, int]:
+        """righe del carrello -> {prodotto_id: quantità totale}"""
+        quantita = {}
+        for r in righe:
+            try:
+                pid, q = int(r["prodotto_id"]), int(r["quantita"])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"Riga non valida: {r}")
+            if q < 1:
+                raise ValueError(f"Quantità non valida per il prodotto {pid}")
+            quantita[pid] = quantita.get(pid, 0) + q
+        return quantita
+
+    def accoda_ordine(self, righe: list[dict], note: str = "") -> dict:
+        """
+        Salva l'ordine nella coda locale quando il DB non è disponibile.
+        Prezzi e disponibilità si verificano solo al reinvio: il totale
+        ritornato è una stima dall'ultima istantanea dei prodotti (se c'è).
+        """
+        if self.coda is None:
+            raise DBNonDisponibile("DB non disponibile e coda ordini non configurata")
+        quantita = self._quantita_carrello(righe)
+        with self._lock:
+            prodotti = self._istantanee.get((self._store(), "prodotti")) or []
+        prezzi = {p["id"]: float(p["prezzo"]) for p in prodotti}
+        totale = (sum(prezzi[pid] * q for pid, q in quantita.items())
+                  if all(pid in prezzi for pid in quantita) else None)
+        voce = {
+            "coda_id": uuid.uuid4().hex,
+            "store": self._store(),
+            "righe": [{"prodotto_id": pid, "quantita": q} for pid, q in quantita.items()],
+            "note": note,
+            "ricevuto_il": time.time(),
+        }
+        in_coda = self.coda.aggiungi(voce)
+        metriche.incrementa("db.degradato.ordini_in_coda")
+        metriche.imposta("db.coda_ordini.lunghezza", in_coda)
+        return {"coda_id": voce["coda_id"], "posizione": in_coda, "totale_stimato": totale}
+
+    def svuota_coda(self) -> list[tuple[str, dict]]:
+        """
+        Reinvia gli ordini in coda, dal più vecchio. Si ferma al primo
+        DBNonDisponibile; gli ordini non più validi vengono scartati.
+        Ritorna [(store, risultato di crea_ordine)] di quelli inseriti.
+        """
+        if self.coda is None:
+            return []
+        inseriti = []
+        store_prima = getattr(self._locale, "store", None)
+        with self.coda.reinvio() as mio:
+            if not mio:
+                return []   # ci pensa un altro worker
+            try:
+                for voce in self.coda.voci():
+                    self.usa_store(voce["store"])
+                    try:
+                        risultato = self.crea_ordine(voce["righe"], voce["note"])
+                    except DBNonDisponibile:
+                        break
+                    except ValueError as e:
+                        self.coda.scarta(voce, str(e))
+                        metriche.incrementa("db.coda_ordini.scartati")
+                        continue
+                    self.coda.togli(voce["coda_id"])
+                    metriche.incrementa("db.coda_ordini.reinviati")
+                    inseriti.append((voce["store"], risultato))
+            finally:
+                self.usa_store(store_prima)
+                metriche.imposta("db.coda_ordini.lunghezza", len(self.coda))
+        return inseriti
+
+    def avvia_svuotamento_coda(self, intervallo: float = 5.0, dopo_inserimento=None):
+        """
+        Thread di background che chiama svuota_coda ogni `intervallo` secondi.
+        dopo_inserimento(store, risultato) viene chiamata per ogni ordine reinviato.
+        """
+        def ciclo():
+            while True:
+                time.sleep(intervallo)
+                try:
+                    for store, risultato in self.svuota_coda():
+                        if dopo_inserimento:
+                            dopo_inserimento(store, risultato)
+                except Exception as e:
+                    print("[DatabaseWrapper] Reinvio coda ordini fallito:", e)
+
+        if self.coda is not None:
+            threading.Thread(target=ciclo, name="coda-ordini", daemon=True).start()
+
+    # ─────────────────────────── SCORTE ───────────────────────────
+
+    def _scala_scorte(self, cur, quantita: dict[int, int]) -> list[dict]:
+        """
+        Toglie i pezzi del carrello dalle scorte, tutto o niente, con un solo
+        UPDATE: la condizione `scorte >= quantità` e il lock di riga fanno sì
+        che due ordini (anche da worker diversi) non vendano lo stesso pezzo.
+        Un prodotto che arriva a zero diventa non disponibile.
+        Ritorna [{"id", "categoria_id"}] dei prodotti esauriti.
+        """
+        ids = list(quantita)
+        caso = " ".join("WHEN %s THEN %s" for _ in ids)
+        coppie = [x for pid in ids for x in (pid, quantita[pid])]
+        # MySQL assegna da sinistra a destra: `disponibile` vede le scorte nuove
+        cur.execute(
+            f"""UPDATE prodotti
+                SET scorte = scorte - CASE id {caso} END,
+                    disponibile = IF(scorte > 0, disponibile, 0)
+                WHERE id IN %s AND scorte >= CASE id {caso} END""",
+            coppie + [ids] + coppie,
+        )
+        if cur.rowcount < len(ids):
+            # un altro ordine ha preso gli ultimi pezzi dopo la nostra lettura
+            cur.execute("SELECT id, scorte FROM prodotti WHERE id IN %s", (ids,))
+            for p in cur.fetchall():
+                if p["scorte"] is not None and p["scorte"] < quantita[p["id"]]:
+                    raise ValueError(
+                        f"Prodotto {p['id']} esaurito (disponibili: {max(p['scorte'], 0)})"
                     )
+            raise ValueError("Scorte insufficienti")
+        cur.execute(
+            "SELECT id, categoria_id FROM prodotti WHERE id IN %s AND scorte=0",
+            (ids,),
+        )
+        return cur.fetchall()
 
-                return {"id": ordine_id, "numero": numero, "totale": totale}
+    @staticmethod
+    def _scala_ordini(cur, ordini: list[int]) -> list[int]:
+        """
+        Sottrae dalle scorte i pezzi degli `ordini` non ancora scalati e li
+        segna come scalati. Serve solo per gli ordini salvati con
+        scorte_scalate=0 dalle versioni che scalavano le scorte a blocchi.
+        Ritorna gli ordini scalati.
+        """
+        cur.execute(
+            "SELECT id FROM ordini WHERE id IN %s AND scorte_scalate=0 FOR UPDATE",
+            (ordini,),
+        )
+        da_scalare = [r["id"] for r in cur.fetchall()]
+        if not da_scalare:
+            return []
+        cur.execute(
+            """UPDATE prodotti p
+               JOIN (SELECT prodotto_id, SUM(quantita) AS q FROM righe_ordine
+                     WHERE ordine_id IN %s GROUP BY prodotto_id) r
+                 ON r.prodotto_id = p.id
+               SET p.scorte = p.scorte - r.q
+               WHERE p.scorte IS NOT NULL""",
+            (da_scalare,),
+        )
+        # aggiornato_il resta quello del cambio di stato (lo legge la cucina)
+        cur.execute(
+            """UPDATE ordini SET scorte_scalate=1, aggiornato_il=aggiornato_il
+               WHERE id IN %s""",
+            (da_scalare,),
+        )
+        return da_scalare
+
+    def get_ordini_cucina(self, ids: list[int] | None = None) -> list:
+        """
+        Ordini aperti (in attesa / in preparazione) nel formato di
+        Pianificatore.carica, con gli istanti in epoch; solo quelli in `ids`,
+        se indicati.
+        """
+        filtro, params = "", [self._store()]
+        if ids is not None:
+            filtro = " AND id IN %s"
+            params.append(ids)
+        # dal primario (il piano deve vedere gli ordini appena scritti), ma
+        # come lettura: non fa passare la sessione al primario per il RYW
+        primario = self._shard(self._store())
+        with self._get_conn(lettura=True, sorgente=primario) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT id, stato, creato_il, aggiornato_il FROM ordini
+                       WHERE store_id=%s AND stato IN ('in_attesa','in_preparazione')"""
+                    + filtro,
+                    params,
+                )
+                ordini = cur.fetchall()
+                righe = {}
+                if ordini:
+                    cur.execute(
+                        """SELECT r.ordine_id, r.quantita, p.preparazione
+                           FROM righe_ordine r
+                           JOIN prodotti p ON p.id=r.prodotto_id
+                           WHERE r.ordine_id IN %s""",
+                        ([o["id"] for o in ordini],),
+                    )
+                    for r in cur.fetchall():
+                        righe.setdefault(r["ordine_id"], []).append(
+                            (r["preparazione"], r["quantita"])
+                        )
+        return [
+            {
+                "id": o["id"],
+                "righe": righe.get(o["id"], []),
+                "creato_il": o["creato_il"].timestamp(),
+                # l'ultimo aggiornamento di un ordine in preparazione è il suo inizio
+                "iniziato_il": (o["aggiornato_il"].timestamp()
+                                if o["stato"] == "in_preparazione" else None),
+            }
+            for o in ordini
+        ]
 
     def get_ordini(self, stato: str | None = None) -> list:
-        with self._get_conn() as conn:
+        with self._get_conn(lettura=True) as conn:
             with conn.cursor() as cur:
                 if stato:
                     cur.execute(
                         """SELECT id, numero, stato, note, totale,
                                   creato_il, aggiornato_il
-                           FROM ordini WHERE stato=%s
+                           FROM ordini WHERE store_id=%s AND stato=%s
                            ORDER BY creato_il DESC""",
-                        (stato,),
+                        (self._store(), stato),
                     )
                 else:
                     cur.execute(
                         """SELECT id, numero, stato, note, totale,
                                   creato_il, aggiornato_il
-                           FROM ordini ORDER BY creato_il DESC LIMIT 100"""
+                           FROM ordini WHERE store_id=%s
+                           ORDER BY creato_il DESC LIMIT 100""",
+                        (self._store(),),
                     )
                 ordini = cur.fetchall()
                 for o in ordini:
@@ -312,17 +1305,17 @@ class DatabaseWrapper:
                 return ordini
 
     def get_ordine(self, ordine_id: int) -> dict | None:
-        with self._get_conn() as conn:
+        with self._get_conn(lettura=True) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """SELECT id, numero, stato, note, totale,
                               creato_il, aggiornato_il
-                       FROM ordini WHERE id=%s""",
-                    (ordine_id,),
+                       FROM ordini WHERE id=%s AND store_id=%s""",
+                    (ordine_id, self._store()),
                 )
                 o = cur.fetchone()
                 if not o:
-                    return None
+                    return self._get_ordine_archiviato(cur, ordine_id)
                 cur.execute(
                     """SELECT r.id, r.quantita, r.prezzo_unit,
                               p.id AS prodotto_id, p.nome AS prodotto
@@ -336,22 +1329,331 @@ class DatabaseWrapper:
                 o["aggiornato_il"] = str(o["aggiornato_il"])
                 return o
 
+    STATI_VALIDI = (
+        "in_attesa", "in_preparazione", "pronto",
+        "consegnato", "annullato",
+    )
+
+    # Passaggi ammessi (singoli e in blocco): avanti di un passo, oppure
+    # in_attesa -> pronto per gli ordini senza preparazione (solo bevande),
+    # indietro di un passo (per annullare un "bump" sbagliato) o annullato.
+    TRANSIZIONI = {
+        "in_attesa":       {"in_preparazione", "pronto", "annullato"},
+        "in_preparazione": {"pronto", "in_attesa", "annullato"},
+        "pronto":          {"consegnato", "in_preparazione", "annullato"},
+        "consegnato":      set(),
+        "annullato":       set(),
+    }
+
     def update_stato_ordine(self, ordine_id: int, stato: str) -> bool:
-        stati_validi = {
-            "in_attesa", "in_preparazione", "pronto",
-            "consegnato", "annullato"
-        }
-        if stato not in stati_validi:
+        if stato not in self.STATI_VALIDI:
             raise ValueError(f"Stato non valido: {stato}")
         with self._get_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    "UPDATE ordini SET stato=%s WHERE id=%s", (stato, ordine_id)
+                    "SELECT stato FROM ordini WHERE id=%s AND store_id=%s FOR UPDATE",
+                    (ordine_id, self._store()),
                 )
-                return cur.rowcount > 0
+                prima = cur.fetchone()
+                if not prima:
+                    return False
+                if prima["stato"] != stato:
+                    if stato not in self.TRANSIZIONI[prima["stato"]]:
+                        raise ValueError(
+                            f"Transizione non valida: {prima['stato']} -> {stato}"
+                        )
+                    cur.execute(
+                        "UPDATE ordini SET stato=%s WHERE id=%s", (stato, ordine_id)
+                    )
+                    self._registra_eventi(cur, [(ordine_id, prima["stato"], stato)])
+                return True
 
-    def get_stats(self) -> dict:
+    def update_stati_ordini(self, transizioni: list[dict]) -> dict:
+        """
+        transizioni = [{"id": X, "stato": "pronto", "expected_stato": "in_preparazione"}, ...]
+        Applica tutti i cambi validi in una transazione con un solo UPDATE.
+        Controllo ottimistico: un ordine cambia solo se è ancora nello stato
+        letto (o in `expected_stato`, se indicato); altrimenti finisce nei conflitti.
+        Un ordine già nello stato chiesto non cambia e non è un conflitto,
+        come in update_stato_ordine.
+        Ritorna {"aggiornati": [ordini completi], "conflitti": [...]}
+        """
+        richieste = {}
+        for t in transizioni:
+            try:
+                oid = int(t["id"])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"Transizione senza id valido: {t}")
+            stato = t.get("stato")
+            if stato not in self.STATI_VALIDI:
+                raise ValueError(f"Stato non valido: {stato}")
+            atteso = t.get("expected_stato")
+            if atteso is not None and atteso not in self.STATI_VALIDI:
+                raise ValueError(f"Stato atteso non valido: {atteso}")
+            if oid in richieste:
+                raise ValueError(f"Ordine {oid} ripetuto nella richiesta")
+            richieste[oid] = (stato, atteso)
+        if not richieste:
+            return {"aggiornati": [], "conflitti": []}
+
+        conflitti = []
         with self._get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, stato FROM ordini WHERE id IN %s AND store_id=%s",
+                    (list(richieste), self._store()),
+                )
+                attuali = {r["id"]: r["stato"] for r in cur.fetchall()}
+
+                applicabili = {}   # id -> (stato_da, stato_a)
+                invariati = []     # già nello stato chiesto: come il PATCH singolo, nessun cambio
+                for oid, (stato, atteso) in richieste.items():
+                    attuale = attuali.get(oid)
+                    if attuale is None:
+                        conflitti.append({"id": oid, "motivo": "non_trovato"})
+                    elif atteso is not None and attuale != atteso:
+                        conflitti.append({"id": oid, "motivo": "stato_cambiato",
+                                          "stato_attuale": attuale})
+                    elif attuale == stato:
+                        invariati.append(oid)
+                    elif stato not in self.TRANSIZIONI[attuale]:
+                        conflitti.append({"id": oid, "motivo": "transizione_non_valida",
+                                          "stato_attuale": attuale})
+                    else:
+                        applicabili[oid] = (attuale, stato)
+                if not applicabili:
+                    return {"aggiornati": self._carica_ordini(cur, invariati),
+                            "conflitti": conflitti}
+
+                ids = list(applicabili)
+                case_nuovo = " ".join("WHEN %s THEN %s" for _ in ids)
+                case_da    = " ".join("WHEN %s THEN %s" for _ in ids)
+                params = [x for oid in ids for x in (oid, applicabili[oid][1])]
+                params += [x for oid in ids for x in (oid, applicabili[oid][0])]
+                params.append(ids)
+                cur.execute(
+                    f"""UPDATE ordini
+                        SET stato = CASE id {case_nuovo} END
+                        WHERE stato = CASE id {case_da} END
+                          AND id IN %s""",
+                    params,
+                )
+
+                if cur.rowcount < len(ids):
+                    # qualcun altro ha cambiato lo stato tra la SELECT e l'UPDATE:
+                    # lettura con lock, altrimenti lo snapshot della transazione
+                    # mostrerebbe ancora lo stato di prima
+                    cur.execute(
+                        "SELECT id, stato FROM ordini WHERE id IN %s FOR UPDATE", (ids,)
+                    )
+                    for r in cur.fetchall():
+                        if r["stato"] != applicabili[r["id"]][1]:
+                            conflitti.append({"id": r["id"], "motivo": "stato_cambiato",
+                                              "stato_attuale": r["stato"]})
+                            del applicabili[r["id"]]
+
+                aggiornati = self._carica_ordini(cur, list(applicabili) + invariati)
+                self._registra_eventi(
+                    cur, [(oid, da, a) for oid, (da, a) in applicabili.items()]
+                )
+                return {"aggiornati": aggiornati, "conflitti": conflitti}
+
+    def _carica_ordini(self, cur, ids: list[int]) -> list:
+        """Ordini completi di righe in due query, invece di una per ordine."""
+        if not ids:
+            return []
+        cur.execute(
+            """SELECT id, numero, stato, note, totale,
+                      creato_il, aggiornato_il
+               FROM ordini WHERE id IN %s ORDER BY creato_il""",
+            (ids,),
+        )
+        ordini = cur.fetchall()
+        cur.execute(
+            """SELECT r.ordine_id, r.id, r.quantita, r.prezzo_unit,
+                      p.id AS prodotto_id, p.nome AS prodotto
+               FROM righe_ordine r
+               JOIN prodotti p ON p.id=r.prodotto_id
+               WHERE r.ordine_id IN %s""",
+            (ids,),
+        )
+        righe = {}
+        for r in cur.fetchall():
+            righe.setdefault(r.pop("ordine_id"), []).append(r)
+        for o in ordini:
+            o["righe"] = righe.get(o["id"], [])
+            o["creato_il"]     = str(o["creato_il"])
+            o["aggiornato_il"] = str(o["aggiornato_il"])
+        return ordini
+
+    # ─────────────────────────── EVENTI ───────────────────────────
+
+    # parte -> (tabella, colonna del numero progressivo)
+    PROGRESSIVI = {"menu": ("menu_modifiche", "versione"), "eventi": ("eventi_ordine", "seq")}
+    MAX_NOVITA = 1000
+
+    def get_novita(self, dopo: dict | None = None) -> dict:
+        """
+        Versioni del menu e seq degli eventi scritti nello store dopo i
+        riferimenti `dopo` ({"menu": V, "eventi": S}; None = solo quelli
+        degli ultimi MARGINE_COMMIT secondi, per partire).
+        Per ogni parte: {"nuovi": [(numero, stabile)], "fino_a": N, "troncato": bool}
+        dove stabile = più vecchio di MARGINE_COMMIT, quindi nessun numero
+        più basso può ancora comparire; fino_a è il riferimento per il giro dopo.
+        """
+        margine = int(self.MARGINE_COMMIT * 1e6)
+        novita = {}
+        with self._get_conn(lettura=True) as conn:
+            with conn.cursor() as cur:
+                for parte, (tabella, colonna) in self.PROGRESSIVI.items():
+                    if dopo is None:
+                        cur.execute(
+                            f"""SELECT {colonna} AS n FROM {tabella}
+                                WHERE store_id=%s
+                                  AND creato_il < NOW(3) - INTERVAL %s MICROSECOND
+                                ORDER BY {colonna} DESC
+                                LIMIT 1""",
+                            (self._store(), margine),
+                        )
+                        riga = cur.fetchone()
+                        da = riga["n"] if riga else 0
+                    else:
+                        da = dopo[parte]
+                    cur.execute(
+                        f"""SELECT {colonna} AS n,
+                                   creato_il < NOW(3) - INTERVAL %s MICROSECOND AS stabile
+                            FROM {tabella}
+                            WHERE store_id=%s AND {colonna} > %s
+                            ORDER BY {colonna}
+                            LIMIT %s""",
+                        (margine, self._store(), da, self.MAX_NOVITA),
+                    )
+                    nuovi = [(r["n"], bool(r["stabile"])) for r in cur.fetchall()]
+                    fino_a = da
+                    for n, stabile in nuovi:
+                        if not stabile:
+                            break
+                        fino_a = n
+                    novita[parte] = {"nuovi": nuovi, "fino_a": fino_a,
+                                     "troncato": len(nuovi) == self.MAX_NOVITA}
+        return novita
+
+    # Un evento con seq più basso può diventare visibile dopo uno con seq più
+    # alto (transazioni concorrenti): chi legge in coda vede solo gli eventi
+    # più vecchi di questo margine, così non ne salta nessuno.
+    MARGINE_COMMIT = 1.0
+
+    PERCENTILI = (50, 90, 99)
+
+    # fase -> (stato di inizio, stato di fine); None = creazione dell'ordine
+    FASI = {
+        "attesa":       (None, "in_preparazione"),
+        "preparazione": ("in_preparazione", "pronto"),
+        "ritiro":       ("pronto", "consegnato"),
+        "totale":       (None, "pronto"),
+    }
+
+    def _registra_eventi(self, cur, eventi: list[tuple]):
+        """
+        eventi = [(ordine_id, stato_da, stato_a)], come ultima scrittura della
+        transazione del cambio. Il lock sulla riga dello store in
+        eventi_versioni (vedi _registra_modifica) rende visibili i seq nello
+        stesso ordine in cui sono assegnati; preso per ultimo, lo si tiene
+        solo per il commit e un seq non resta invisibile per più di
+        MARGINE_COMMIT dietro a un'attesa su altri lock.
+        """
+        if not eventi:
+            return
+        cur.execute(
+            """INSERT INTO eventi_versioni (store_id) VALUES (%s)
+               ON DUPLICATE KEY UPDATE store_id=store_id""",
+            (self._store(),),
+        )
+        # un solo INSERT multiriga (executemany di pymysql)
+        cur.executemany(
+            """INSERT INTO eventi_ordine (store_id, ordine_id, stato_da, stato_a)
+               VALUES (%s,%s,%s,%s)""",
+            [(self._store(), oid, da, a) for oid, da, a in eventi],
+        )
+        if len(eventi) == 1:
+            self._segna_modifica("eventi", cur.lastrowid)
+            return
+        # i seq di ogni riga servono a prendi_modifiche; lastrowid è il primo
+        # del blocco e, col lock dello store, gli altri eventi >= sono nostri
+        cur.execute(
+            """SELECT seq FROM eventi_ordine
+               WHERE store_id=%s AND ordine_id IN %s AND seq >= %s""",
+            (self._store(), [e[0] for e in eventi], cur.lastrowid),
+        )
+        for r in cur.fetchall():
+            self._segna_modifica("eventi", r["seq"])
+
+    def get_eventi(self, da_seq: int = 0, limite: int = 500) -> list:
+        """
+        Eventi dello store con seq > da_seq, in ordine di seq.
+        Sempre dal primario: una replica indietro di più di MARGINE_COMMIT
+        non ha ancora eventi che il primario mostrava già, e chi segue la
+        coda li salterebbe ripartendo da un seq più alto preso altrove.
+        """
+        primario = self._shard(self._store())
+        with self._get_conn(lettura=True, sorgente=primario) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT seq, ordine_id, stato_da, stato_a, creato_il
+                       FROM eventi_ordine
+                       WHERE store_id=%s AND seq > %s
+                         AND creato_il < NOW(3) - INTERVAL %s MICROSECOND
+                       ORDER BY seq
+                       LIMIT %s""",
+                    (self._store(), da_seq, int(self.MARGINE_COMMIT * 1e6), limite),
+                )
+                eventi = cur.fetchall()
+        for e in eventi:
+            e["creato_il"] = str(e["creato_il"])
+        return eventi
+
+    def get_tempi_fasi(self, da, a) -> dict:
+        """
+        Percentili (secondi) di ogni fase per gli ordini creati tra `da` e `a`:
+        {"attesa": {"conteggio": n, "p50": ..., "p90": ..., "p99": ...}, ...}
+        """
+        with self._get_conn(lettura=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT e.ordine_id, e.stato_da, e.stato_a, e.creato_il
+                       FROM eventi_ordine e
+                       JOIN eventi_ordine c
+                         ON c.ordine_id = e.ordine_id AND c.stato_da IS NULL
+                       WHERE c.store_id=%s AND c.creato_il >= %s AND c.creato_il < %s
+                       ORDER BY e.seq""",
+                    (self._store(), da, a),
+                )
+                eventi = cur.fetchall()
+
+        # primo istante in cui ogni ordine ha raggiunto ogni stato
+        raggiunto = {}
+        for e in eventi:
+            stati = raggiunto.setdefault(e["ordine_id"], {})
+            chiave = None if e["stato_da"] is None else e["stato_a"]
+            stati.setdefault(chiave, e["creato_il"])
+
+        risultato = {}
+        for fase, (inizio, fine) in self.FASI.items():
+            durate = sorted(
+                (s[fine] - s[inizio]).total_seconds()
+                for s in raggiunto.values()
+                if inizio in s and fine in s
+            )
+            voce = {"conteggio": len(durate)}
+            for p in self.PERCENTILI:
+                # nearest-rank
+                voce[f"p{p}"] = (durate[max(0, -(-p * len(durate) // 100) - 1)]
+                                 if durate else None)
+            risultato[fase] = voce
+        return risultato
+
+    def get_stats(self) -> dict:
+        with self._get_conn(lettura=True) as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT
@@ -363,280 +1665,194 @@ class DatabaseWrapper:
                       COALESCE(SUM(CASE WHEN stato='consegnato'
                                    THEN totale END), 0) AS incasso
                     FROM ordini
-                    WHERE DATE(creato_il) = CURDATE()
-                """)
+                    WHERE store_id=%s AND creato_il >= CURDATE()
+                """, (self._store(),))
                 return cur.fetchone()
-=======
-import os
-import json
-import pymysql
-from pymysql import err as pymysql_err
-import sqlite3
-import base64
-import tempfile
-import pathlib
 
+    def get_stats_globali(self) -> dict:
+        """
+        Statistiche di oggi per tutti i punti vendita.
+        Interroga in parallelo ogni shard, così uno store lento non blocca gli altri;
+        uno shard irraggiungibile non toglie i dati degli altri.
+        Ritorna {"negozi": {store_id: stats}, "shard_non_disponibili": {shard: errore}}
+        """
+        def stats_shard(config: dict) -> list:
+            with self._get_conn(config, lettura=True) as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT
+                          store_id,
+                          COUNT(*) AS totale,
+                          SUM(stato='in_attesa')      AS in_attesa,
+                          SUM(stato='in_preparazione') AS in_preparazione,
+                          SUM(stato='pronto')         AS pronti,
+                          SUM(stato='consegnato')     AS consegnati,
+                          COALESCE(SUM(CASE WHEN stato='consegnato'
+                                       THEN totale END), 0) AS incasso
+                        FROM ordini
+                        WHERE creato_il >= CURDATE()
+                        GROUP BY store_id
+                    """)
+                    return cur.fetchall()
 
-class DatabaseWrapper:
-    def __init__(self):
-        # Legge le credenziali da variabili d'ambiente per facilità di configurazione
-        host = os.getenv('DB_HOST', 'mysql-3f12020f-galvani5d.j.aivencloud.com')
-        user = os.getenv('DB_USER', 'avnadmin')
-        password = os.getenv('DB_PASSWORD', 'AVNS_idAGBvmY7bsHyDkUXBM')
-        database = os.getenv('DB_NAME', 'defaultdb')
-        port = int(os.getenv('DB_PORT', '13861'))
-
-        self.use_sqlite = False
-        self.connection = None
-
-        if host == 'IL_TUO_HOST_QUI' or not host:
-            print('[DatabaseWrapper] DB_HOST non configurato: uso fallback SQLite locale')
-            self._init_sqlite()
-            return
+        shards = self._shard_distinti()
+        negozi, errori = {}, {}
+        with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+            futuri = {pool.submit(stats_shard, conf): conf for conf in shards}
+        for futuro, conf in futuri.items():
+            try:
+                for r in futuro.result():
+                    negozi[r.pop("store_id")] = r
+            except Exception as e:
+                errori["{}:{}/{}".format(*self._chiave(conf))] = str(e)
+                metriche.incrementa("db.stats.shard_falliti")
+        return {"negozi": negozi, "shard_non_disponibili": errori}
 
-        try:
-            # support SSL CA for Aiven if provided via env
-            ssl_ca_path = os.getenv('DB_SSL_CA_PATH')
-            ssl_ca_b64 = os.getenv('DB_SSL_CA_B64')
-            ssl_kwargs = None
-            if ssl_ca_b64 and not ssl_ca_path:
-                # scrive il certificato in un file temporaneo persistente nella cartella backend
-                ca_file = pathlib.Path(os.path.join(os.getcwd(), 'aiven-ca.pem'))
-                if not ca_file.exists():
-                    ca_file.write_bytes(base64.b64decode(ssl_ca_b64))
-                ssl_ca_path = str(ca_file)
-            if ssl_ca_path:
-                ssl_kwargs = {'ca': ssl_ca_path}
-
-            connect_args = dict(
-                host=host,
-                user=user,
-                password=password,
-                database=database,
-                port=port,
-                cursorclass=pymysql.cursors.DictCursor,
-                autocommit=False,
-                connect_timeout=5,
-            )
-            if ssl_kwargs:
-                connect_args['ssl'] = ssl_kwargs
+    # ─────────────────────────── ARCHIVIO ─────────────────────────
 
-            self.connection = pymysql.connect(**connect_args)
-            print('[DatabaseWrapper] Connesso a MySQL:', host)
-        except Exception as e:
-            print('[DatabaseWrapper] Impossibile connettersi a MySQL:', e)
-            print('[DatabaseWrapper] Uso fallback SQLite locale')
-            self._init_sqlite()
-
-    def _init_sqlite(self):
-        self.use_sqlite = True
-        # file persistente nella workspace
-        db_path = os.path.join(os.getcwd(), 'backend_local.db')
-        self.connection = sqlite3.connect(db_path, check_same_thread=False)
-        self.connection.row_factory = sqlite3.Row
-
-    def crea_tabelle_se_non_esistono(self):
-        # Crea le tabelle appropriate per il DB in uso (MySQL o SQLite)
-        try:
-            if self.use_sqlite:
-                cur = self.connection.cursor()
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS prodotti (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        name TEXT,
-                        price REAL,
-                        category TEXT,
-                        image TEXT
-                    )
-                ''')
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS ordini (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        items_json TEXT,
-                        total_price REAL,
-                        status TEXT DEFAULT 'nuovo'
-                    )
-                ''')
-                self.connection.commit()
-            else:
-                with self.connection.cursor() as cursor:
-                    cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS prodotti (
-                            id INT AUTO_INCREMENT PRIMARY KEY,
-                            name VARCHAR(100),
-                            price DECIMAL(10,2),
-                            category VARCHAR(50),
-                            image TEXT
-                        )
-                    """)
-                    cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS ordini (
-                            id INT AUTO_INCREMENT PRIMARY KEY,
-                            items_json TEXT,
-                            total_price DECIMAL(10,2),
-                            status VARCHAR(50) DEFAULT 'nuovo'
-                        )
-                    """)
-                self.connection.commit()
-        except Exception as e:
-            print('[DatabaseWrapper] Errore creando tabelle:', e)
-            # Se la creazione su MySQL fallisce, forziamo fallback a SQLite per poter lavorare in locale
-            if not self.use_sqlite:
-                print('[DatabaseWrapper] Forzo fallback a SQLite')
-                self._init_sqlite()
-                self.crea_tabelle_se_non_esistono()
-            else:
-                raise
+    STATI_ARCHIVIABILI = ("consegnato", "annullato")
 
-        # seed di esempio per testing locale se la tabella prodotti è vuota
-        try:
-            menu = self.get_menu()
-            if not menu:
-                sample = [
-                    ('Classic Burger', 'panini', 6.5, None),
-                    ('Cheese Burger', 'panini', 7.5, None),
-                    ('Coca-Cola', 'bevande', 2.0, None),
-                    ('Menu Completo', 'menu', 10.0, None),
-                ]
-                for name, category, price, image in sample:
-                    try:
-                        self.add_product(name, category, price, image)
-                    except Exception:
-                        pass
-        except Exception:
-            # non blocchiamo l'avvio se il seed fallisce
-            pass
-
-    # --- Menu / prodotti ---
-    def get_menu(self):
-        try:
-            if self.use_sqlite:
-                cur = self.connection.cursor()
-                cur.execute('SELECT * FROM prodotti ORDER BY id ASC')
-                rows = cur.fetchall()
-                return [dict(r) for r in rows]
-            else:
-                with self.connection.cursor() as cursor:
-                    cursor.execute('SELECT * FROM prodotti ORDER BY id ASC')
-                    return cursor.fetchall()
-        except Exception as e:
-            msg = str(e).lower()
-            if 'doesn' in msg or 'does not exist' in msg or 'no such table' in msg:
-                print('[DatabaseWrapper] get_menu: tabella prodotti mancante, ricreo tabelle')
-                try:
-                    self.crea_tabelle_se_non_esistono()
-                    return self.get_menu()
-                except Exception:
-                    pass
-            raise
+    def archivia_ordini(self, giorni: int = 30, batch: int = 500,
+                        pausa: float = 0.2, max_blocchi: int = 10) -> dict:
+        """
+        Sposta in ordini_archivio / righe_ordine_archivio gli ordini chiusi
+        dello store corrente più vecchi di `giorni`, a blocchi di `batch` ordini.
+        Ogni blocco è una transazione a sé; tra un blocco e l'altro si
+        attende `pausa` secondi per non monopolizzare il DB.
+        Si ferma dopo `max_blocchi` blocchi, così una chiamata dura poco:
+        ritorna {"archiviati": n, "altri": True se ne restano da archiviare}.
+        """
+        if giorni < 1:
+            # _next_numero_ordine conta gli ordini di oggi: non si toccano
+            raise ValueError("Si possono archiviare solo ordini di almeno 1 giorno fa")
+        if batch < 1 or max_blocchi < 1:
+            raise ValueError("Dimensione e numero dei batch devono essere positivi")
 
-    def add_product(self, name, category, price, image=None):
-        try:
-            if self.use_sqlite:
-                cur = self.connection.cursor()
-                cur.execute('INSERT INTO prodotti (name, price, category, image) VALUES (?, ?, ?, ?)', (name, price, category, image))
-                self.connection.commit()
-                return cur.lastrowid
-            else:
-                with self.connection.cursor() as cursor:
-                    cursor.execute('INSERT INTO prodotti (name, price, category, image) VALUES (%s, %s, %s, %s)', (name, price, category, image))
-                    self.connection.commit()
-                    return cursor.lastrowid
-        except Exception as e:
-            msg = str(e).lower()
-            if 'doesn' in msg or 'does not exist' in msg or 'no such table' in msg:
-                print('[DatabaseWrapper] add_product: tabella prodotti mancante, ricreo tabelle')
-                self.crea_tabelle_se_non_esistono()
-                return self.add_product(name, category, price, image)
-            raise
+        totale = 0
+        for blocco in range(max_blocchi):
+            if blocco:
+                time.sleep(pausa)
+            with self._get_conn(lunga=True) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """SELECT id FROM ordini
+                           WHERE store_id=%s AND stato IN %s AND scorte_scalate=1
+                             AND creato_il < CURDATE() - INTERVAL %s DAY
+                           ORDER BY id
+                           LIMIT %s
+                           FOR UPDATE""",
+                        (self._store(), self.STATI_ARCHIVIABILI, giorni - 1, batch),
+                    )
+                    ids = [r["id"] for r in cur.fetchall()]
+                    if not ids:
+                        return {"archiviati": totale, "altri": False}
 
-    def update_product(self, product_id, name=None, category=None, price=None, image=None):
-        parts = []
-        params = []
-        if name is not None:
-            parts.append('name=?' if self.use_sqlite else 'name=%s'); params.append(name)
-        if category is not None:
-            parts.append('category=?' if self.use_sqlite else 'category=%s'); params.append(category)
-        if price is not None:
-            parts.append('price=?' if self.use_sqlite else 'price=%s'); params.append(price)
-        if image is not None:
-            parts.append('image=?' if self.use_sqlite else 'image=%s'); params.append(image)
-        if not parts:
-            return False
-        sql = 'UPDATE prodotti SET ' + ', '.join(parts) + (' WHERE id=?' if self.use_sqlite else ' WHERE id=%s')
-        params.append(product_id)
-        if self.use_sqlite:
-            cur = self.connection.cursor()
-            cur.execute(sql, tuple(params))
-            self.connection.commit()
-        else:
-            with self.connection.cursor() as cursor:
-                cursor.execute(sql, tuple(params))
-            self.connection.commit()
-        return True
-
-    def delete_product(self, product_id):
-        if self.use_sqlite:
-            cur = self.connection.cursor()
-            cur.execute('DELETE FROM prodotti WHERE id=?', (product_id,))
-            self.connection.commit()
-        else:
-            with self.connection.cursor() as cursor:
-                cursor.execute('DELETE FROM prodotti WHERE id=%s', (product_id,))
-            self.connection.commit()
+                    cur.execute(
+                        """INSERT INTO ordini_archivio
+                           (id, store_id, numero, stato, note, totale,
+                            creato_il, aggiornato_il)
+                           SELECT id, store_id, numero, stato, note, totale,
+                                  creato_il, aggiornato_il
+                           FROM ordini WHERE id IN %s""",
+                        (ids,),
+                    )
+                    cur.execute(
+                        """INSERT INTO righe_ordine_archivio
+                           (id, ordine_id, prodotto_id, prodotto, quantita, prezzo_unit)
+                           SELECT r.id, r.ordine_id, r.prodotto_id, p.nome,
+                                  r.quantita, r.prezzo_unit
+                           FROM righe_ordine r
+                           JOIN prodotti p ON p.id=r.prodotto_id
+                           WHERE r.ordine_id IN %s""",
+                        (ids,),
+                    )
+                    # righe prima degli ordini: evita il lavoro del CASCADE
+                    cur.execute("DELETE FROM righe_ordine WHERE ordine_id IN %s", (ids,))
+                    cur.execute("DELETE FROM ordini WHERE id IN %s", (ids,))
+            totale += len(ids)
+            if len(ids) < batch:
+                return {"archiviati": totale, "altri": False}
+        return {"archiviati": totale, "altri": True}
 
-    # --- Ordini ---
-    def get_orders(self):
-        try:
-            if self.use_sqlite:
-                cur = self.connection.cursor()
-                cur.execute('SELECT * FROM ordini ORDER BY id DESC')
-                rows = cur.fetchall()
-                return [dict(r) for r in rows]
-            else:
-                with self.connection.cursor() as cursor:
-                    cursor.execute('SELECT * FROM ordini ORDER BY id DESC')
-                    return cursor.fetchall()
-        except Exception as e:
-            msg = str(e).lower()
-            if 'doesn' in msg or 'does not exist' in msg or 'no such table' in msg:
-                print('[DatabaseWrapper] get_orders: tabella ordini mancante, ricreo tabelle')
-                try:
-                    self.crea_tabelle_se_non_esistono()
-                    return self.get_orders()
-                except Exception:
-                    pass
-            raise
+    # ─────────────────────────── EXPORT ───────────────────────────
 
-    def add_order(self, items, total_price):
-        items_json = json.dumps(items, ensure_ascii=False)
-        try:
-            if self.use_sqlite:
-                cur = self.connection.cursor()
-                cur.execute('INSERT INTO ordini (items_json, total_price, status) VALUES (?, ?, ?)', (items_json, total_price, 'nuovo'))
-                self.connection.commit()
-                return cur.lastrowid
-            else:
-                with self.connection.cursor() as cursor:
-                    cursor.execute('INSERT INTO ordini (items_json, total_price, status) VALUES (%s, %s, %s)', (items_json, total_price, 'nuovo'))
-                    self.connection.commit()
-                    return cursor.lastrowid
-        except Exception as e:
-            msg = str(e).lower()
-            if 'doesn' in msg or 'does not exist' in msg or 'no such table' in msg:
-                print('[DatabaseWrapper] add_order: tabella ordini mancante, ricreo tabelle')
-                self.crea_tabelle_se_non_esistono()
-                return self.add_order(items, total_price)
-            raise
+    def esporta_ordini(self, da, a, archivio: bool = True, blocco: int = 500):
+        """
+        Generatore degli ordini dello store creati tra `da` e `a`, con le
+        righe, in ordine di creazione (prima l'archivio, poi gli ordini vivi).
+        Memoria costante: gli ordini arrivano da un cursore lato server
+        (SSDictCursor) e le righe si leggono a blocchi di `blocco` ordini
+        su una seconda connessione alla stessa replica.
+        Le connessioni si aprono al primo next(): è lì che escono gli
+        errori di DB, prima che la risposta HTTP sia partita.
+        """
+        store = self._store()
+        primario = self._shard(store)
+        sorgente = self._config_lettura(primario)
+        fonti = [
+            ("ordini_archivio",
+             """SELECT id, ordine_id, prodotto_id, prodotto, quantita, prezzo_unit
+                FROM righe_ordine_archivio WHERE ordine_id IN %s""", True),
+            ("ordini",
+             """SELECT r.id, r.ordine_id, r.prodotto_id, p.nome AS prodotto,
+                       r.quantita, r.prezzo_unit
+                FROM righe_ordine r JOIN prodotti p ON p.id=r.prodotto_id
+                WHERE r.ordine_id IN %s""", False),
+        ]
+        if not archivio:
+            fonti = fonti[1:]
 
-    def update_order_status(self, order_id, status):
-        if self.use_sqlite:
-            cur = self.connection.cursor()
-            cur.execute('UPDATE ordini SET status=? WHERE id=?', (status, order_id))
-            self.connection.commit()
-        else:
-            with self.connection.cursor() as cursor:
-                cursor.execute('UPDATE ordini SET status=%s WHERE id=%s', (status, order_id))
-            self.connection.commit()
+        with self._get_conn(primario, sorgente=sorgente, lunga=True) as conn, \
+             self._get_conn(primario, sorgente=sorgente, lunga=True) as conn_righe:
+            with conn.cursor() as cur:
+                # lo stream può durare minuti e il client può leggere piano
+                cur.execute("SET SESSION max_execution_time=0, net_write_timeout=600")
+            # niente `with` sul cursore lato server: se il client si disconnette
+            # la sua close() scaricherebbe tutto il resto del risultato, mentre
+            # chiudere la connessione (lo fa _get_conn) interrompe l'invio
+            cur = conn.cursor(pymysql.cursors.SSDictCursor)
+            with conn_righe.cursor() as cur_righe:
+                for tabella, query_righe, archiviato in fonti:
+                    cur.execute(
+                        f"""SELECT id, numero, stato, note, totale,
+                                   creato_il, aggiornato_il
+                            FROM {tabella}
+                            WHERE store_id=%s AND creato_il >= %s AND creato_il < %s
+                            ORDER BY creato_il, id""",
+                        (store, da, a),
+                    )
+                    while True:
+                        ordini = cur.fetchmany(blocco)
+                        if not ordini:
+                            break
+                        cur_righe.execute(query_righe, ([o["id"] for o in ordini],))
+                        righe = {}
+                        for r in cur_righe.fetchall():
+                            righe.setdefault(r["ordine_id"], []).append(r)
+                        metriche.incrementa("export.ordini", len(ordini))
+                        for o in ordini:
+                            o["righe"] = righe.get(o["id"], [])
+                            o["archiviato"] = archiviato
+                            yield o
 
->>>>>>> 690fc1a (inizio del progetto, parte ordini e aggiunta al menù)
+    def _get_ordine_archiviato(self, cur, ordine_id: int) -> dict | None:
+        cur.execute(
+            """SELECT id, numero, stato, note, totale,
+                      creato_il, aggiornato_il
+               FROM ordini_archivio WHERE id=%s AND store_id=%s""",
+            (ordine_id, self._store()),
+        )
+        o = cur.fetchone()
+        if not o:
+            return None
+        cur.execute(
+            """SELECT id, quantita, prezzo_unit, prodotto_id, prodotto
+               FROM righe_ordine_archivio
+               WHERE ordine_id=%s""",
+            (ordine_id,),
+        )
+        o["righe"] = cur.fetchall()
+        o["creato_il"]     = str(o["creato_il"])
+        o["aggiornato_il"] = str(o["aggiornato_il"])
+        o["archiviato"]    = True
+        return o
@@ -0,0 +1,92 @@
+import threading
+import time
+
+from metriche import metriche
+
+
+class DBNonDisponibile(Exception):
+    """Il DB non risponde (interruttore aperto, connessione persa o timeout)."""
+
+
+class Interruttore:
+    """
+    Circuit breaker di un DB (uno per shard).
+
+    - chiuso: le chiamate passano. Dopo `soglia` fallimenti di fila
+      (errore di connessione, timeout, o chiamata più lenta di
+      `latenza_max` secondi) si apre.
+    - aperto: ogni chiamata fallisce subito con DBNonDisponibile, senza
+      occupare un thread ad aspettare il DB. Dopo `pausa` secondi passa
+      a semi_aperto.
+    - semi_aperto: passa una sola chiamata di prova; se va bene si
+      richiude, altrimenti si riapre per un'altra pausa.
+    """
+
+    def __init__(self, nome: str, soglia: int = 5, latenza_max: float = 2.0,
+                 pausa: float = 15.0, orologio=time.monotonic):
+        self.nome = nome
+        self.soglia = soglia
+        self.latenza_max = latenza_max
+        self.pausa = pausa
+        self._orologio = orologio
+        self._lock = threading.Lock()
+        self._stato = "chiuso"
+        self._fallimenti = 0
+        self._aperto_il = None
+        self._prova_in_corso = False
+        metriche.imposta(f"db.interruttore.{nome}", self._stato)
+
+    def entra(self):
+        """Da chiamare prima di usare il DB: solleva DBNonDisponibile se aperto."""
+        with self._lock:
+            if self._stato == "aperto":
+                if self._orologio() - self._aperto_il < self.pausa:
+                    metriche.incrementa("db.interruttore.rifiutate")
+                    raise DBNonDisponibile(f"DB {self.nome} non disponibile")
+                self._cambia("semi_aperto")
+            if self._stato == "semi_aperto":
+                if self._prova_in_corso:
+                    metriche.incrementa("db.interruttore.rifiutate")
+                    raise DBNonDisponibile(f"DB {self.nome} in verifica")
+                self._prova_in_corso = True
+
+    def successo(self, durata: float):
+        """Il DB ha risposto in `durata` secondi (troppo lento conta come fallimento)."""
+        if durata > self.latenza_max:
+            metriche.incrementa("db.interruttore.lente")
+            self.fallimento()
+            return
+        with self._lock:
+            self._prova_in_corso = False
+            self._fallimenti = 0
+            if self._stato != "chiuso":
+                self._cambia("chiuso")
+
+    def fallimento(self):
+        with self._lock:
+            self._prova_in_corso = False
+            self._fallimenti += 1
+            if self._stato == "semi_aperto" or (
+                self._stato == "chiuso" and self._fallimenti >= self.soglia
+            ):
+                self._aperto_il = self._orologio()
+                self._cambia("aperto")
+                metriche.incrementa("db.interruttore.aperture")
+
+    def rilascia(self):
+        """La chiamata è finita senza esito (es. GeneratorExit): libera solo la prova."""
+        with self._lock:
+            self._prova_in_corso = False
+
+    def stato(self) -> dict:
+        with self._lock:
+            stato = {"stato": self._stato, "fallimenti": self._fallimenti}
+            if self._stato == "aperto":
+                stato["riprova_tra"] = round(
+                    max(0.0, self._aperto_il + self.pausa - self._orologio()), 1
+                )
+            return stato
+
+    def _cambia(self, stato: str):
+        self._stato = stato
+        metriche.imposta(f"db.interruttore.{self.nome}", stato)
@@ -0,0 +1,47 @@
+import threading
+from collections import defaultdict
+
+
+class Metriche:
+    """
+    Contatori e misure in memoria, condivisi da tutti i thread del processo.
+    Esposti così come sono da GET /api/metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contatori = defaultdict(int)
+        self._valori = {}
+        self._misure = {}
+
+    def incrementa(self, nome: str, n: int = 1):
+        with self._lock:
+            self._contatori[nome] += n
+
+    def imposta(self, nome: str, valore):
+        """Valore istantaneo (es. ritardo di una replica)."""
+        with self._lock:
+            self._valori[nome] = valore
+
+    def osserva(self, nome: str, valore: float):
+        """Aggiunge un campione (es. una latenza in ms): conteggio, somma, max."""
+        with self._lock:
+            m = self._misure.setdefault(nome, {"conteggio": 0, "somma": 0.0, "max": 0.0})
+            m["conteggio"] += 1
+            m["somma"] += valore
+            m["max"] = max(m["max"], valore)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            misure = {
+                nome: {**m, "media": m["somma"] / m["conteggio"] if m["conteggio"] else 0.0}
+                for nome, m in self._misure.items()
+            }
+            return {
+                "contatori": dict(self._contatori),
+                "valori": dict(self._valori),
+                "misure": misure,
+            }
+
+
+metriche = Metriche()
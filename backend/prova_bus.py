@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Prova del bus fra worker: avvia N processi, ognuno con il suo BusLocale
+sulla stessa cartella, e fa pubblicare a turno a ciascuno degli eventi.
+Misura quanti arrivano a tutti gli altri e con che ritardo.
+
+    python prova_bus.py [--worker 4] [--eventi 500] [--ritmo 1000]
+
+Non usa il DB né Flask: stessi messaggi che app.py manda a ogni modifica.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import statistics
+import tempfile
+import time
+
+from bus import BusLocale
+
+
+def worker(n: int, cartella: str, totale: int, eventi: int, ritmo: float,
+           pronti, via, risultati):
+    bus = BusLocale(cartella)
+    ricevuti = []   # (origine, seq, ms di propagazione)
+
+    def registra(evento):
+        ricevuti.append((evento["worker"], evento["seq"],
+                         (time.time() - evento["inviato_il"]) * 1000))
+
+    bus.iscrivi("stati", registra)
+    pronti.put(n)
+    via.wait()
+
+    # pubblica a turno con gli altri worker, `ritmo` eventi/secondo in tutto
+    for seq in range(n, eventi, totale):
+        bus.pubblica({"tipo": "stati", "store": "principale", "worker": n,
+                      "seq": seq, "ordini": [[seq, "pronto"]]})
+        time.sleep(totale / ritmo)
+    time.sleep(0.5)   # lascia arrivare gli ultimi
+    risultati.put((n, ricevuti))
+    bus.chiudi()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--worker", type=int, default=4)
+    parser.add_argument("--eventi", type=int, default=500, help="eventi pubblicati in tutto")
+    parser.add_argument("--ritmo", type=float, default=1000, help="eventi/secondo in tutto")
+    args = parser.parse_args()
+
+    cartella = tempfile.mkdtemp(prefix="prova-bus-")
+    pronti, risultati, via = mp.Queue(), mp.Queue(), mp.Event()
+    processi = [
+        mp.Process(target=worker, args=(n, cartella, args.worker, args.eventi,
+                                        args.ritmo, pronti, via, risultati))
+        for n in range(args.worker)
+    ]
+    for p in processi:
+        p.start()
+    for _ in processi:
+        pronti.get()   # tutti i socket sono aperti prima del primo evento
+    via.set()
+    esiti = dict(risultati.get() for _ in processi)
+    for p in processi:
+        p.join()
+    os.rmdir(cartella)
+
+    print(f"{args.worker} worker, {args.eventi} eventi a {args.ritmo:.0f}/s")
+    print(f"{'worker':<7} {'attesi':>7} {'ricevuti':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    tutti = []
+    for n, ricevuti in sorted(esiti.items()):
+        attesi = sum(1 for seq in range(args.eventi) if seq % args.worker != n)
+        ms = sorted(r[2] for r in ricevuti)
+        tutti += ms
+        if not ms:
+            print(f"{n:<7} {attesi:>7} {0:>9}")
+            continue
+        print(f"{n:<7} {attesi:>7} {len(ms):>9} {statistics.median(ms):8.3f} "
+              f"{ms[max(0, -(-99 * len(ms) // 100) - 1)]:8.3f} {ms[-1]:8.3f}")
+    attesi = args.eventi * (args.worker - 1)
+    print(f"consegnati {len(tutti)}/{attesi} ({100 * len(tutti) / attesi:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
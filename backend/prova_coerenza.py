@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Prova di coerenza fra worker: avvia N processi con l'app vera (stesso DB,
+stessa cartella del bus), fa scrivere a turno a ciascuno prodotti, ordini e
+cambi di stato su uno store di prova, perdendo apposta una parte degli
+eventi del bus, e controlla che dopo due giri di verifica tutti i worker
+abbiano lo stesso indice, le stesse pagine di categoria e gli stessi ordini
+in cucina, uguali a quelli letti dal DB.
+
+    python prova_coerenza.py [--worker 3] [--operazioni 100] [--ritmo 20]
+                             [--perdita 0.3] [--giro 1]
+
+Usa il DB delle variabili DB_* (come app.py), con lo schema già creato
+(POST /api/setup), e uno store nuovo a ogni esecuzione. Esce con codice 1
+se un worker non converge.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import random
+import sys
+import tempfile
+import time
+
+PREPARAZIONI = ["griglia:240", "griglia:240,friggitrice:180", "friggitrice:180", "bar:20"]
+PROSSIMO_STATO = {"in_attesa": "in_preparazione", "in_preparazione": "pronto",
+                  "pronto": "consegnato"}
+
+
+def fotografia(client, store: str, cid: int) -> dict:
+    """Stato in memoria del worker, letto dalle stesse API dei client."""
+    h = {"X-Store-Id": store}
+    prodotti = client.get("/api/prodotti/cerca?q=prova&limite=50", headers=h).get_json()["data"]
+    pagina = client.get(f"/api/categorie/{cid}/prodotti", headers=h).get_json()["data"]
+    cucina = client.get("/api/cucina", headers=h).get_json()["data"]
+    return {
+        "indice": sorted((p["id"], p["nome"], p["prezzo"], p["disponibile"]) for p in prodotti),
+        "pagina": sorted((p["id"], p["nome"], p["prezzo"], p["disponibile"]) for p in pagina),
+        "cucina": sorted(int(oid) for oid in cucina["ordini"]),
+    }
+
+
+def dal_db(app, store: str, cid: int) -> dict:
+    """Lo stesso stato ricostruito da zero dal primario."""
+    app.db.usa_store(store)
+    app.db.usa_primario(True)
+    try:
+        indice = app.IndiceProdotti()
+        indice.carica(app.db.get_prodotti())
+        pagina = app.db.get_prodotti_categoria(cid)
+        return {
+            "indice": sorted((p["id"], p["nome"], p["prezzo"], p["disponibile"])
+                             for p in indice.cerca("prova", 50)),
+            "pagina": sorted((p["id"], p["nome"], float(p["prezzo"]), p["disponibile"])
+                             for p in pagina["prodotti"]),
+            "cucina": sorted(o["id"] for o in app.db.get_ordini_cucina()),
+        }
+    finally:
+        app.db.usa_primario(False)
+
+
+def esegui(client, store: str, comando: tuple):
+    h = {"X-Store-Id": store}
+    tipo, *args = comando
+    if tipo == "categoria":
+        return client.post("/api/categorie", json={"nome": args[0]}, headers=h)
+    if tipo == "prodotto":
+        cid, nome, prezzo, preparazione = args
+        return client.post("/api/prodotti", headers=h, json={
+            "categoria_id": cid, "nome": nome, "prezzo": prezzo,
+            "preparazione": preparazione,
+        })
+    if tipo == "modifica":
+        pid, campi = args
+        return client.put(f"/api/prodotti/{pid}", json=campi, headers=h)
+    if tipo == "ordine":
+        righe = [{"prodotto_id": pid, "quantita": 1} for pid in args[0]]
+        return client.post("/api/ordini", json={"righe": righe}, headers=h)
+    if tipo == "stato":
+        oid, stato = args
+        return client.patch(f"/api/ordini/{oid}/stato", json={"stato": stato}, headers=h)
+    raise ValueError(f"Comando sconosciuto: {tipo}")
+
+
+def worker(n: int, store: str, cartella: str, giro: float, perdita: float,
+           comandi, risposte):
+    os.environ["BUS_DIR"] = cartella
+    os.environ["COERENZA_SECONDI"] = str(giro)
+    import app
+    from metriche import metriche
+
+    # una parte degli eventi non parte: li deve recuperare la verifica sul DB
+    rng = random.Random(n)
+    pubblica = app.bus.pubblica
+    app.bus.pubblica = lambda evento: 0 if rng.random() < perdita else pubblica(evento)
+    client = app.app.test_client()
+    risposte.put(("pronto", n))
+
+    while True:
+        comando = comandi.get()
+        if comando[0] == "fine":
+            break
+        if comando[0] == "fotografia":
+            cid = comando[1]
+            contatori = metriche.snapshot()["contatori"]
+            risposte.put((fotografia(client, store, cid), dal_db(app, store, cid), {
+                parte: contatori.get(f"coerenza.ricostruzioni.{parte}", 0)
+                for parte in ("menu", "eventi")
+            }))
+            continue
+        r = esegui(client, store, comando)
+        risposte.put((r.status_code, r.get_json()))
+    app.bus.chiudi()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--worker", type=int, default=3)
+    parser.add_argument("--operazioni", type=int, default=100)
+    parser.add_argument("--ritmo", type=float, default=20,
+                        help="operazioni/secondo: la prova copre più giri di verifica")
+    parser.add_argument("--perdita", type=float, default=0.3,
+                        help="quota di eventi del bus scartati")
+    parser.add_argument("--giro", type=float, default=1.0,
+                        help="COERENZA_SECONDI dei worker")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # uno store nuovo a ogni prova: i dati restano nel DB, ma non si mescolano
+    store = f"prova-coerenza-{os.getpid()}"
+    cartella = tempfile.mkdtemp(prefix="prova-coerenza-")
+    risposte = mp.Queue()
+    code = [mp.Queue() for _ in range(args.worker)]
+    processi = [
+        mp.Process(target=worker, args=(n, store, cartella, args.giro, args.perdita,
+                                        code[n], risposte),
+                   daemon=True)   # se la prova si interrompe, i worker non restano appesi
+        for n in range(args.worker)
+    ]
+    for p in processi:
+        p.start()
+    for _ in processi:
+        risposte.get()
+
+    def chiedi(n: int, comando: tuple):
+        code[n].put(comando)
+        stato, corpo = risposte.get()
+        if stato >= 400:
+            raise RuntimeError(f"worker {n}, {comando}: {stato} {corpo}")
+        return corpo.get("data")
+
+    rng = random.Random(args.seed)
+    cid = chiedi(0, ("categoria", "Prova"))["id"]
+    prodotti = [
+        chiedi(i % args.worker, ("prodotto", cid, f"Prova {i}", 5 + i, prep))["id"]
+        for i, prep in enumerate(PREPARAZIONI * 2)
+    ]
+    # ogni worker costruisce indice, pagina e piano della cucina
+    for n in range(args.worker):
+        code[n].put(("fotografia", cid))
+        risposte.get()
+
+    aperti = {}                  # ordine_id -> stato
+    disponibili = set(prodotti)  # si ordinano solo quelli in menu
+    for i in range(args.operazioni):
+        time.sleep(1 / args.ritmo)
+        n = i % args.worker
+        scelta = rng.random()
+        if (scelta < 0.4 or not aperti) and disponibili:
+            carrello = rng.sample(sorted(disponibili), min(len(disponibili), rng.randint(1, 3)))
+            ordine = chiedi(n, ("ordine", carrello))
+            aperti[ordine["id"]] = "in_attesa"
+        elif scelta < 0.8 and aperti:
+            oid = rng.choice(list(aperti))
+            aperti[oid] = PROSSIMO_STATO[aperti[oid]]
+            chiedi(n, ("stato", oid, aperti[oid]))
+            if aperti[oid] == "consegnato":
+                del aperti[oid]
+        else:
+            pid = rng.choice(prodotti)
+            campi = rng.choice([{"prezzo": rng.randint(3, 15)},
+                                {"disponibile": rng.random() < 0.7}])
+            chiedi(n, ("modifica", pid, campi))
+            if campi.get("disponibile") is True:
+                disponibili.add(pid)
+            elif campi.get("disponibile") is False:
+                disponibili.discard(pid)
+
+    # margine di commit + due giri: il primo vede le perdite, il secondo conferma
+    time.sleep(1.0 + 2 * args.giro + 0.5)
+    esiti = []
+    for n in range(args.worker):
+        code[n].put(("fotografia", cid))
+        esiti.append(risposte.get())
+    for n in range(args.worker):
+        code[n].put(("fine",))
+    for p in processi:
+        p.join()
+
+    print(f"{args.worker} worker, {args.operazioni} operazioni a {args.ritmo:.0f}/s, "
+          f"{args.perdita:.0%} eventi persi, giro {args.giro}s")
+    print(f"{'worker':<7} {'indice':>7} {'pagina':>7} {'cucina':>7} "
+          f"{'ricostr. menu':>14} {'ricostr. ordini':>16}")
+    divergenti = 0
+    for n, (memoria, db, ricostruzioni) in enumerate(esiti):
+        uguali = {parte: memoria[parte] == db[parte] for parte in memoria}
+        divergenti += not all(uguali.values())
+        print(f"{n:<7} " + " ".join(f"{'ok' if uguali[p] else 'DIVERSO':>7}"
+                                    for p in ("indice", "pagina", "cucina"))
+              + f" {ricostruzioni['menu']:>14} {ricostruzioni['eventi']:>16}")
+        for parte, ok in uguali.items():
+            if not ok:
+                print(f"  {parte}: memoria {memoria[parte]}\n  {parte}: DB      {db[parte]}")
+    if divergenti:
+        print(f"{divergenti} worker non convergono")
+        sys.exit(1)
+    print("tutti i worker coincidono con il DB")
+
+
+if __name__ == "__main__":
+    main()
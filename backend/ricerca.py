@@ -0,0 +1,160 @@
+import re
+import threading
+import unicodedata
+
+MAX_PREFISSO = 20
+
+# peso di un campo nel punteggio: il nome conta più della descrizione
+PESI = {"nome": 3.0, "categoria": 2.0, "descrizione": 1.0}
+
+# sotto questa somiglianza (trigrammi in comune) un termine non corrisponde
+SOGLIA_TRIGRAMMI = 0.4
+
+
+def normalizza(testo: str | None) -> str:
+    """'Jalapeños Caffè' -> 'jalapenos caffe' (minuscole, senza accenti)."""
+    testo = unicodedata.normalize("NFKD", testo or "")
+    testo = "".join(c for c in testo if not unicodedata.combining(c))
+    return re.sub(r"[^a-z0-9]+", " ", testo.lower()).strip()
+
+
+def trigrammi(parola: str, intera: bool = True) -> set[str]:
+    """intera=False: `parola` è un inizio di parola, niente trigramma di fine."""
+    parola = f"  {parola} " if intera else f"  {parola}"
+    return {parola[i:i + 3] for i in range(len(parola) - 2)}
+
+
+class IndiceProdotti:
+    """
+    Indice in memoria dei prodotti di uno store, per la ricerca e
+    l'autocompletamento del pannello staff.
+    - prefissi: ogni parola di nome, categoria e descrizione è indicizzata
+      per tutti i suoi prefissi ("che" trova "Cheese" e "Cheddar");
+    - trigrammi: solo sulle parole del nome, per tollerare errori di
+      battitura quando nessun prefisso corrisponde ("chesee" trova
+      "Cheeseburger": il confronto è anche con l'inizio della parola).
+    Tutte le parole cercate devono corrispondere (AND).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prodotti = {}    # id -> dati mostrati nei risultati
+        self._prefissi = {}    # prefisso -> {id: peso}
+        self._trigrammi = {}   # trigramma -> {id: parole del nome che lo contengono}
+        self._parole = {}      # id -> ({prefisso: peso}, {parola del nome})
+
+    def carica(self, prodotti: list[dict]):
+        with self._lock:
+            self._prodotti, self._prefissi, self._trigrammi, self._parole = {}, {}, {}, {}
+            for p in prodotti:
+                self._inserisci(p)
+
+    def aggiorna(self, prodotto: dict):
+        with self._lock:
+            self._togli(prodotto["id"])
+            self._inserisci(prodotto)
+
+    def rimuovi(self, prodotto_id: int):
+        with self._lock:
+            self._togli(prodotto_id)
+
+    def segna_non_disponibile(self, prodotto_id: int):
+        with self._lock:
+            if prodotto_id in self._prodotti:
+                self._prodotti[prodotto_id]["disponibile"] = 0
+
+    def cerca(self, testo: str, limite: int = 10) -> list[dict]:
+        termini = normalizza(testo).split()
+        if not termini:
+            return []
+        with self._lock:
+            punteggi = None
+            for termine in termini:
+                trovati = dict(self._prefissi.get(termine[:MAX_PREFISSO], {}))
+                if not trovati:
+                    trovati = self._simili(termine)
+                if punteggi is None:
+                    punteggi = trovati
+                else:
+                    punteggi = {pid: punteggi[pid] + s
+                                for pid, s in trovati.items() if pid in punteggi}
+                if not punteggi:
+                    return []
+            migliori = sorted(
+                punteggi.items(),
+                key=lambda x: (-x[1], -self._prodotti[x[0]]["disponibile"],
+                               self._prodotti[x[0]]["nome"]),
+            )[:limite]
+            return [dict(self._prodotti[pid]) for pid, _ in migliori]
+
+    # ─────────────────────────── Interni ──────────────────────────
+
+    def _inserisci(self, p: dict):
+        pid = p["id"]
+        self._prodotti[pid] = {
+            "id": pid,
+            "nome": p["nome"],
+            "descrizione": p.get("descrizione") or "",
+            "prezzo": float(p["prezzo"]),
+            "immagine": p.get("immagine"),
+            "disponibile": int(p.get("disponibile", 1)),
+            "categoria_id": p.get("categoria_id"),
+            "categoria": p.get("categoria"),
+        }
+        prefissi = {}
+        for campo, peso in PESI.items():
+            for parola in normalizza(p.get(campo)).split():
+                for i in range(1, min(len(parola), MAX_PREFISSO) + 1):
+                    prefissi[parola[:i]] = max(prefissi.get(parola[:i], 0), peso)
+        parole_nome = set(normalizza(p["nome"]).split())
+        for prefisso, peso in prefissi.items():
+            self._prefissi.setdefault(prefisso, {})[pid] = peso
+        for parola in parole_nome:
+            for t in trigrammi(parola):
+                self._trigrammi.setdefault(t, {}).setdefault(pid, set()).add(parola)
+        self._parole[pid] = (prefissi, parole_nome)
+
+    def _togli(self, pid: int):
+        if pid not in self._prodotti:
+            return
+        prefissi, parole_nome = self._parole.pop(pid)
+        del self._prodotti[pid]
+        for prefisso in prefissi:
+            voci = self._prefissi[prefisso]
+            voci.pop(pid, None)
+            if not voci:
+                del self._prefissi[prefisso]
+        for parola in parole_nome:
+            for t in trigrammi(parola):
+                voci = self._trigrammi.get(t)
+                if voci is not None:
+                    voci.pop(pid, None)
+                    if not voci:
+                        del self._trigrammi[t]
+
+    def _simili(self, termine: str) -> dict:
+        """
+        Prodotti con una parola del nome simile a `termine` (Jaccard sui
+        trigrammi). Si confronta anche con gli inizi di parola lunghi
+        quanto il termine (± una lettera saltata o in più), perché si
+        cerca mentre si scrive: "chesee" deve trovare "Cheeseburger".
+        """
+        cercati = trigrammi(termine, intera=False)
+        candidati = set()
+        for t in cercati:
+            for pid, parole in self._trigrammi.get(t, {}).items():
+                candidati.update((pid, parola) for parola in parole)
+        trovati = {}
+        for pid, parola in candidati:
+            somiglianza = len(trigrammi(termine) & trigrammi(parola)) / len(
+                trigrammi(termine) | trigrammi(parola)
+            )
+            for n in range(len(termine) - 1, len(termine) + 2):
+                if 0 < n < len(parola):
+                    inizio = trigrammi(parola[:n], intera=False)
+                    somiglianza = max(somiglianza,
+                                      len(cercati & inizio) / len(cercati | inizio))
+            if somiglianza >= SOGLIA_TRIGRAMMI:
+                punteggio = PESI["nome"] * somiglianza
+                trovati[pid] = max(trovati.get(pid, 0), punteggio)
+        return trovati
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Simulatore del pranzo: rigioca un'ora e mezza di ordini con picco a metà
+e confronta la coda in ordine di arrivo (fifo) con il Pianificatore (spt).
+
+    python simula_pranzo.py [--minuti 90] [--picco 3.0] [--carico 1.5] [--seed 1]
+                            [--capacita griglia=2,friggitrice=1,bar=1]
+
+Non usa il DB: stesso menu del seed, orologio simulato a passi di 5 secondi.
+Le postazioni si dimensionano sul picco (--carico = lavoro arrivato al
+picco / lavoro che le postazioni smaltiscono): sopra 1 la coda si
+forma al picco e si smaltisce dopo, ed è lì che la politica conta. Molto
+sopra, la coda cresce per tutto il pranzo con qualsiasi politica (con
+CAPACITA_DEFAULT e il picco di default la friggitrice avrebbe ore di
+lavoro arretrato).
+"""
+import argparse
+import math
+import random
+import statistics
+import time
+
+from cucina import Pianificatore, leggi_preparazione
+
+# (preparazione, peso nella scelta) — come i prodotti del seed
+MENU = [
+    ("griglia:240", 30),                           # panini
+    ("griglia:240,friggitrice:180,bar:20", 25),    # menu
+    ("bar:20", 25),                                # bevande
+    ("friggitrice:180", 20),                       # extra
+]
+PASSO = 5.0
+PEZZI_MEDI = 2.5   # carrelli da 1 a 4 pezzi
+
+
+def lavoro_per_ordine() -> dict:
+    """Secondi di lavoro medi che un ordine porta a ogni stazione."""
+    totale = sum(peso for _, peso in MENU)
+    lavoro = {}
+    for prep, peso in MENU:
+        for stazione, secondi in leggi_preparazione(prep):
+            lavoro[stazione] = lavoro.get(stazione, 0) + PEZZI_MEDI * peso / totale * secondi
+    return lavoro
+
+
+def capacita_per_carico(picco: float, carico: float) -> dict:
+    """Postazioni per stazione perché al picco il lavoro sia `carico` volte la capacità."""
+    return {
+        stazione: max(1, math.ceil(secondi * picco / 60 / carico))
+        for stazione, secondi in lavoro_per_ordine().items()
+    }
+
+
+def leggi_capacita(testo: str) -> dict:
+    """'griglia=2,friggitrice=1' -> {"griglia": 2, "friggitrice": 1}"""
+    capacita = {}
+    for voce in testo.split(","):
+        stazione, _, n = voce.partition("=")
+        capacita[stazione.strip()] = int(n)
+    return capacita
+
+
+def genera_ordini(minuti: int, picco: float, rng: random.Random) -> list:
+    """Arrivi di Poisson con intensità a campana (ordini/minuto), carrelli da 1 a 4 pezzi."""
+    base = picco / 6
+    ordini, t = [], 0.0
+    while True:
+        t += rng.expovariate(picco / 60)
+        if t > minuti * 60:
+            return ordini
+        # thinning: accetta con probabilità intensità(t)/picco
+        fase = (t / (minuti * 60) - 0.5) * 4
+        intensita = base + (picco - base) * math.exp(-fase * fase)
+        if rng.random() > intensita / picco:
+            continue
+        prep, pesi = zip(*MENU)
+        carrello = rng.choices(prep, weights=pesi, k=rng.randint(1, 4))
+        ordini.append((t, [(p, 1) for p in carrello]))
+
+
+def simula(ordini: list, politica: str, capacita: dict) -> dict:
+    adesso = [0.0]
+    cucina = Pianificatore(capacita, politica=politica, orologio=lambda: adesso[0])
+    iniziati, creati, attese, tempi_chiamata = set(), {}, [], []
+
+    def chiama(f, *args):
+        inizio = time.perf_counter()
+        f(*args)
+        tempi_chiamata.append(time.perf_counter() - inizio)
+
+    prossimo = 0
+    while prossimo < len(ordini) or creati:
+        adesso[0] += PASSO
+        while prossimo < len(ordini) and ordini[prossimo][0] <= adesso[0]:
+            chiama(cucina.aggiungi_ordine, prossimo, ordini[prossimo][1])
+            creati[prossimo] = adesso[0]
+            prossimo += 1
+
+        piano = cucina.piano()
+        primo_inizio = {}
+        for compiti in piano["stazioni"].values():
+            for c in compiti:
+                oid = c["ordine_id"]
+                primo_inizio[oid] = min(primo_inizio.get(oid, c["inizio"]), c["inizio"])
+        for oid, pronto in piano["ordini"].items():
+            if oid in iniziati and pronto <= adesso[0]:
+                chiama(cucina.aggiorna_stato, oid, "pronto")
+                attese.append(adesso[0] - creati.pop(oid))
+                iniziati.discard(oid)
+            elif oid not in iniziati and primo_inizio.get(oid, adesso[0]) <= adesso[0]:
+                chiama(cucina.aggiorna_stato, oid, "in_preparazione")
+                iniziati.add(oid)
+
+    attese.sort()
+    return {
+        "ordini": len(attese),
+        "media_min": statistics.mean(attese) / 60,
+        "p50_min": attese[len(attese) // 2] / 60,
+        "p90_min": attese[int(len(attese) * 0.9)] / 60,
+        "max_min": attese[-1] / 60,
+        "chiamata_us": statistics.mean(tempi_chiamata) * 1e6,
+        "chiamata_max_us": max(tempi_chiamata) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--minuti", type=int, default=90)
+    parser.add_argument("--picco", type=float, default=3.0, help="ordini/minuto al picco")
+    parser.add_argument("--carico", type=float, default=1.5,
+                        help="lavoro al picco / capacità delle postazioni")
+    parser.add_argument("--capacita", type=leggi_capacita,
+                        help="postazioni fisse, es. griglia=2,friggitrice=1,bar=1")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    ordini = genera_ordini(args.minuti, args.picco, random.Random(args.seed))
+    capacita = args.capacita or capacita_per_carico(args.picco, args.carico)
+    lavoro = lavoro_per_ordine()
+    print(f"{len(ordini)} ordini in {args.minuti} minuti, stazioni: {capacita}")
+    print("carico al picco: " + ", ".join(
+        f"{s} {lavoro[s] * args.picco / 60 / capacita.get(s, 1):.0%}" for s in lavoro
+    ))
+    print(f"{'politica':<8} {'media':>7} {'p50':>7} {'p90':>7} {'max':>7} {'µs/chiamata':>12} {'µs max':>9}")
+    for politica in ("fifo", "spt"):
+        r = simula(ordini, politica, capacita)
+        print(f"{politica:<8} {r['media_min']:6.1f}' {r['p50_min']:6.1f}' {r['p90_min']:6.1f}' "
+              f"{r['max_min']:6.1f}' {r['chiamata_us']:12.0f} {r['chiamata_max_us']:9.0f}")
+
+
+if __name__ == "__main__":
+    main()